@@ -0,0 +1,430 @@
+
+# acquire.py
+
+# This file collects data from the bluetooth TPMS sensors. Each
+# advertisement is decoded as soon as it is received, and stored as a
+# timestamped sample in a ring buffer which the caller drains at its
+# own pace. It is shared by bscan.py and btpressure.py.
+
+# Several bluetooth adapters can scan at once, each in its own thread,
+# with the same advertisement heard by more than one adapter only kept
+# once. Samples can also be followed from the sample file written by
+# bscan.py, so that btpressure.py can view a scan run by another process.
+# Scanners other than bluepy's, such as those of simscan.py, can be used
+# in place of the radio. An adapter that fails is reset from its own
+# thread, with growing delays between resets.
+
+
+import collections
+import threading
+import time
+import os
+import subprocess
+
+from tpms import counts
+from series import RunningStats
+
+# bluepy is only needed to scan with a real adapter
+try: from bluepy.btle import Scanner, DefaultDelegate, BTLEException
+except ImportError: Scanner,DefaultDelegate,BTLEException = None,object,None
+
+# errors of a scan that the adapter is reset for; any other error is a
+# fault of the program, and stops the scan of the adapter
+if BTLEException != None: RADIO_ERRORS = (BTLEException,IOError,OSError)
+else: RADIO_ERRORS = (IOError,OSError)
+
+# advertising data type of manufacturer data
+MANUFACTURER = 0xFF
+
+
+# This function creates an empty ring buffer of samples. Once full, the
+# oldest samples are dropped as new ones arrive.
+def sampleBuffer(size=4096):
+    return collections.deque(maxlen=size)
+
+# This function formats a sample as a line of the sample file: time,
+# MAC address, pressure, and temperature, separated by commas.
+def formatSample(registry,sample):
+    t,entry,pressure,temp = sample
+    return "%.3f,%s,%s,%s" % (t,registry.sensors[entry].mac,pressure,temp)
+
+# This function reads a line of the sample file into a sample, or returns
+# None if the line is malformed or not from a known sensor.
+def parseSample(registry,line):
+    fields = line.strip().split(",")
+    if len(fields) != 4: return None
+    sensor = registry.lookup(fields[1])
+    if sensor == None: return None
+    try: return (float(fields[0]),sensor.channel,float(fields[2]),
+        float(fields[3]))
+    except ValueError: return None
+
+# This function removes and returns all samples currently in the buffer.
+def drain(samples):
+    found = []
+    while True:
+        try: found.append(samples.popleft())
+        except IndexError: return found
+
+# This class determines the interaction between the device and the 
+# BLE sensor. Every advertisement from a known sensor is decoded on
+# arrival, including repeats of unchanged data, and pushed into the
+# ring buffer as a (time,entry,pressure,temp) sample. When several
+# adapters scan at once, advertisements already heard by another adapter
+# are dropped. The advertisements kept and the ones that could not be
+# decoded are counted per sensor.
+class ScanDelegate(DefaultDelegate):
+    def __init__(self,registry,samples,iface=0,dedup=None,recorder=None,
+        log=None,feed=None):
+        DefaultDelegate.__init__(self)
+        self.registry = registry # known sensors
+        self.samples = samples # ring buffer of decoded samples
+        self.iface = iface # adapter number, as in hci0
+        self.dedup = dedup # Dedup shared by all adapters, if any
+        self.recorder = recorder # Recorder of raw advertisements, if any
+        self.log = log # rawlog.LogWriter of samples, if any
+        self.feed = feed # feed.FeedWriter of samples, if any
+        self.received = [0] * len(registry) # advertisements per channel
+        self.failed = [0] * len(registry) # undecodable ones per channel
+        self.lastHeard = [None] * len(registry) # time of the last one
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        # all other devices are rejected with a single lookup
+        sensor = self.registry.lookup(dev.addr)
+        if sensor == None: return
+        ManuData = dev.getValueText(MANUFACTURER)
+        t = time.time()
+        if (self.dedup != None and 
+            self.dedup.isDuplicate(dev.addr,ManuData,self.iface,t)): return
+        if self.recorder != None: self.recorder.write(t,dev.addr,ManuData)
+        raw = counts(ManuData)
+        if raw == None:
+            self.failed[sensor.channel] += 1
+            return
+        self.received[sensor.channel] += 1
+        self.lastHeard[sensor.channel] = t
+        pressure,temp = sensor.convert(raw)
+        self.samples.append((t,sensor.channel,pressure,temp))
+        if self.log != None:
+            self.log.write(t,sensor.channel,pressure,temp,raw)
+        if self.feed != None:
+            self.feed.write(t,sensor.channel,pressure,temp,raw)
+
+# This class records the raw advertisements of known sensors to a file, as
+# lines of time, MAC address, and manufacturer data, separated by commas.
+# The file can be replayed by simscan.ReplayScanner.
+class Recorder(object):
+
+    def __init__(self,path):
+        self.file = open(path, "at")
+        self.lock = threading.Lock() # adapters record from their threads
+
+    # This function records one advertisement.
+    def write(self,t,mac,ManuData):
+        with self.lock:
+            self.file.write("%.3f,%s,%s\n" % (t,mac,ManuData))
+
+    # This function closes the file.
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# This class finds advertisements heard by more than one adapter. An
+# advertisement is a duplicate if the same data from the same sensor was
+# heard by a different adapter within the time window. Repeats heard by
+# the same adapter are real repeats, and are kept.
+class Dedup(object):
+
+    def __init__(self,window=0.2,pruneEvery=1000):
+        self.window = window # seconds
+        self.pruneEvery = pruneEvery # checks between forgetting old data
+        self.checks = 0
+        self.heard = dict() # (mac,data) -> (time,adapter)
+        self.dropped = 0 # duplicates found
+        self.lock = threading.Lock() # adapters check from their threads
+
+    # This function records an advertisement, and determines if it is a
+    # duplicate of one heard by another adapter.
+    def isDuplicate(self,mac,ManuData,iface,t):
+        with self.lock:
+            key = mac,ManuData
+            last = self.heard.get(key)
+            if (last != None and last[1] != iface and 
+                t - last[0] <= self.window):
+                self.dropped += 1
+                return True
+            self.heard[key] = t,iface
+            self.checks += 1
+            if self.checks % self.pruneEvery == 0: self.prune(t)
+            return False
+
+    # This function forgets advertisements older than the time window.
+    def prune(self,t):
+        for key in list(self.heard):
+            if t - self.heard[key][0] > self.window: del self.heard[key]
+
+# This function resets a bluetooth adapter, waiting until it is done.
+def resetAdapter(iface):
+    try: subprocess.call(["sudo","hciconfig","hci%d" % iface,"reset"])
+    except OSError: pass
+
+# This class decides how a failing adapter is recovered, and keeps track
+# of its health. After each failed scan the adapter is reset, then left
+# for a delay that doubles with each failure in a row, up to limit
+# seconds. After threshold failures in a row, the adapter is left alone
+# for cooldown seconds, and reset once more before the next try. Resets
+# and delays happen in the scan thread of the adapter, never in the
+# user interface.
+class Recovery(object):
+
+    def __init__(self,iface=0,base=1.0,limit=60.0,threshold=5,
+        cooldown=300.0,reset=None):
+        self.iface = iface # adapter number, as in hci0
+        self.base = base # seconds of delay after the first failure
+        self.limit = limit # seconds of delay at most
+        self.threshold = threshold # failures in a row before giving up
+        self.cooldown = cooldown # seconds left alone after giving up
+        self.reset = resetAdapter if reset == None else reset
+        self.failures = 0 # failed scans
+        self.streak = 0 # failed scans since the last good one
+        self.resets = 0 # adapter resets
+        self.resetTime = 0.0 # seconds spent resetting
+        self.lastReset = None # seconds taken by the last reset
+        self.lastGood = None # time of the last good scan
+        self.openUntil = None # end of the cooldown, while giving up
+        self.error = None # error that stopped the scan, if any
+
+    # This function records a good scan.
+    def success(self):
+        self.lastGood = time.time()
+        self.streak = 0
+
+    # This function returns the delay after the current failure.
+    def delay(self):
+        return min(self.limit,self.base * 2 ** (self.streak - 1))
+
+    # This function resets the adapter, timing the reset.
+    def resetNow(self):
+        start = time.time()
+        self.reset(self.iface)
+        self.lastReset = time.time() - start
+        self.resetTime += self.lastReset
+        self.resets += 1
+
+    # This function recovers from a failed scan. The waits are made with
+    # wait, which returns True if the scan was stopped meanwhile.
+    def failure(self,wait=time.sleep):
+        self.failures += 1
+        self.streak += 1
+        if self.streak >= self.threshold:
+            self.openUntil = time.time() + self.cooldown
+            if wait(self.cooldown): return
+            self.openUntil = None
+            self.resetNow()
+        else:
+            self.resetNow()
+            wait(self.delay())
+
+    # This function records an error that is not the adapter's, after
+    # which the adapter is not tried again.
+    def fatal(self,error):
+        self.error = error
+
+    # This function returns the state of the adapter: "ok", "retrying"
+    # after recent failures, "resting" during the cooldown, or "failed"
+    # after an error that is not the adapter's.
+    def state(self):
+        if self.error != None: return "failed"
+        if self.openUntil != None: return "resting"
+        if self.streak > 0: return "retrying"
+        return "ok"
+
+    # This function returns the health of the adapter as a dictionary.
+    def health(self):
+        since = None
+        if self.lastGood != None: since = time.time() - self.lastGood
+        return {"iface":self.iface,"state":self.state(),
+            "failures":self.failures,"streak":self.streak,
+            "resets":self.resets,"lastReset":self.lastReset,
+            "meanReset":self.resetTime/self.resets if self.resets else None,
+            "sinceGood":since,
+            "error":None if self.error == None else repr(self.error)}
+
+# This class runs the bluetooth scan in the background so that the user
+# interface never waits on the radio. It owns the scanner of one adapter
+# and keeps it scanning continuously while the delegate fills the ring
+# buffer, which may be shared with the threads of other adapters. The
+# scanner is made by makeScanner from the adapter number, which is bluepy's
+# Scanner unless another backend is given. ImportError is raised if there
+# is neither.
+class ScanThread(threading.Thread):
+
+    def __init__(self,registry,window=0.5,size=4096,iface=0,
+        samples=None,dedup=None,makeScanner=None,recorder=None,log=None,
+        recovery=None,feed=None):
+        threading.Thread.__init__(self)
+        self.daemon = True # does not keep the program open on exit
+        self.window = window # seconds between clearing seen devices
+        self.iface = iface # adapter number, as in hci0
+        self.samples = sampleBuffer(size) if samples == None else samples
+        self.delegate = ScanDelegate(registry,self.samples,iface,dedup,
+            recorder,log,feed)
+        if makeScanner == None and Scanner == None:
+            raise ImportError("bluepy is needed to scan with hci%d" % iface)
+        self.makeScanner = Scanner if makeScanner == None else makeScanner
+        self.recovery = Recovery(iface) if recovery == None else recovery
+        self.scanning = True
+        self.stopped = threading.Event() # cuts recovery waits short
+        self.scanTimes = RunningStats() # seconds taken by each process
+
+    # This function scans until the thread is stopped. If the radio
+    # fails, the scanner is stopped and let go, the adapter is recovered
+    # by self.recovery, and a new scanner is made for the next try. Only
+    # this thread's adapter is reset, so other adapters keep scanning. Any
+    # other error is recorded in self.recovery and raised, ending the
+    # thread, as resetting the adapter would not help.
+    def run(self):
+        scanner = None
+        while self.scanning:
+            try:
+                if scanner == None:
+                    scanner = self.makeScanner(self.iface).withDelegate(
+                        self.delegate)
+                scanner.clear()
+                scanner.start()
+                while self.scanning:
+                    start = time.time()
+                    scanner.process(self.window)
+                    self.scanTimes.add(time.time() - start)
+                    self.recovery.success()
+                    # forgets devices so unrelated ones do not pile up
+                    scanner.clear()
+                scanner.stop()
+            except RADIO_ERRORS:
+                if scanner != None:
+                    # the helper process of the scanner may be gone
+                    try: scanner.stop()
+                    except Exception: pass
+                    scanner = None
+                if self.scanning: self.recovery.failure(self.stopped.wait)
+            except Exception as e:
+                self.recovery.fatal(e)
+                raise
+
+    # This function stops the scan at the end of the current window.
+    def stop(self):
+        self.scanning = False
+        self.stopped.set()
+
+# This class scans with several adapters at once, one ScanThread each,
+# merging their samples into one ring buffer. It is used in the same way
+# as a single ScanThread.
+class ScanGroup(object):
+
+    def __init__(self,registry,ifaces=(0,),window=0.5,size=4096,
+        makeScanner=None,recorder=None,log=None,feed=None):
+        self.samples = sampleBuffer(size)
+        # duplicates are only possible with more than one adapter
+        self.dedup = Dedup() if len(ifaces) > 1 else None
+        self.threads = [ScanThread(registry,window,size,iface,
+            self.samples,self.dedup,makeScanner,recorder,log,feed=feed)
+            for iface in ifaces]
+
+    # This function starts scanning with all adapters.
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    # This function stops all adapters at the end of their windows.
+    def stop(self):
+        for thread in self.threads:
+            thread.stop()
+
+    # This function waits for all adapters to stop.
+    def join(self,timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+
+    # This function returns the health of each adapter.
+    def health(self):
+        return [thread.recovery.health() for thread in self.threads]
+
+    # This function returns the advertisements received, those that could
+    # not be decoded, and the time of the last one, per channel, over all
+    # adapters.
+    def counts(self):
+        delegates = [thread.delegate for thread in self.threads]
+        received = [sum(counted) for counted in
+            zip(*[delegate.received for delegate in delegates])]
+        failed = [sum(counted) for counted in
+            zip(*[delegate.failed for delegate in delegates])]
+        lastHeard = [max([t for t in heard if t != None] or [None])
+            for heard in zip(*[delegate.lastHeard for delegate in delegates])]
+        return received,failed,lastHeard
+
+    # This function returns the time taken by the scans of each adapter.
+    def scanTimes(self):
+        return [(thread.iface,thread.scanTimes) for thread in self.threads]
+
+# This class follows a sample file written by another process, such as
+# bscan.py, in the background. New lines are read as they are appended
+# and put in the ring buffer, in the same way as ScanThread, so that the
+# user interface can view a scan without running its own.
+class FollowThread(threading.Thread):
+
+    def __init__(self,registry,path,window=0.5,size=4096):
+        threading.Thread.__init__(self)
+        self.daemon = True # does not keep the program open on exit
+        self.registry = registry # known sensors
+        self.path = path # sample file to follow
+        self.window = window # seconds between checks for new lines
+        self.samples = sampleBuffer(size)
+        self.following = True
+        self.received = [0] * len(registry) # samples read per channel
+        self.lastHeard = [None] * len(registry) # time of the last one
+
+    # This function reads new lines until the thread is stopped. Reading
+    # starts at the end of the file, and starts over if the file is
+    # replaced by a shorter one.
+    def run(self):
+        f = None
+        partial = ""
+        while self.following:
+            if f == None:
+                if not os.path.isfile(self.path):
+                    time.sleep(self.window)
+                    continue
+                f = open(self.path, "rt")
+                f.seek(0, os.SEEK_END)
+            elif os.path.getsize(self.path) < f.tell():
+                f.seek(0)
+                partial = ""
+            # clears the end of file, so that appended lines are read
+            else: f.seek(f.tell())
+            lines = (partial + f.read()).split("\n")
+            # the last line may still be being written
+            partial = lines.pop()
+            for line in lines:
+                sample = parseSample(self.registry,line)
+                if sample == None: continue
+                self.samples.append(sample)
+                self.received[sample[1]] += 1
+                self.lastHeard[sample[1]] = sample[0]
+            time.sleep(self.window)
+        if f != None: f.close()
+
+    # This function stops following at the end of the current window.
+    def stop(self):
+        self.following = False
+
+    # These functions match those of ScanGroup. Samples read from the file
+    # were already decoded, and there are no adapters to report on.
+
+    def counts(self):
+        return self.received,[0] * len(self.received),self.lastHeard
+
+    def scanTimes(self):
+        return []
+
+    def health(self):
+        return []
@@ -0,0 +1,247 @@
+
+# bench.py
+
+# This file measures the acquisition pipeline of btpressure.py without
+# bluetooth sensors, root access, or waiting for a real run. Synthetic
+# sensors from simscan.py, among any number of unrelated devices and with
+# dropouts, feed a simulated run as fast as it can go. For each stage,
+# and for each whole timer tick, the number of calls, the mean, 95th
+# percentile, and longest time per call, and the total time are reported,
+# with the memory each call kept and the most it used above that at its
+# start, and the memory in use at the end. Memory is traced with
+# tracemalloc where there is one, which slows every stage alike, and is
+# otherwise the growth of the peak resident size. The scan stage includes
+# making up the advertisements. redrawAll is only measured when a display
+# is available. Without Tkinter, only the stages of the scan are measured.
+
+# To run:
+#   > python bench.py [--minutes 120] [--decoys 300] [--dropout 0.1]
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try: import tracemalloc
+except ImportError: tracemalloc = None
+try: import resource
+except ImportError: resource = None
+
+from acquire import ScanDelegate, sampleBuffer, drain
+from simscan import SyntheticScanner
+from tpms import loadRegistry
+
+# This function reads the command line options.
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description="Measure the acquisition pipeline with fake sensors.")
+    parser.add_argument("--minutes",type=float,default=120,
+        help="simulated length of the run (default 120)")
+    parser.add_argument("--spacing",type=float,default=3,
+        help="minutes between points (default 3)")
+    parser.add_argument("--tick",type=float,default=0.1,
+        help="seconds between timer ticks (default 0.1)")
+    parser.add_argument("--rate",type=float,default=1.0,
+        help="advertisements per second per device (default 1)")
+    parser.add_argument("--decoys",type=int,default=300,
+        help="number of unrelated devices (default 300)")
+    parser.add_argument("--dropout",type=float,default=0.1,
+        help="chance an advertisement is lost (default 0.1)")
+    parser.add_argument("--seed",type=int,default=1,
+        help="random seed, for repeatable runs (default 1)")
+    return parser.parse_args(argv)
+
+# the most memory used during each call being timed, from the outermost
+# in, as one item lists
+measuring = []
+
+# This function returns the memory in use and the most used since the
+# last call, in bytes, and counts the most used in every call being
+# timed. Without tracemalloc, both are the peak resident size, which only
+# grows.
+def memoryNow():
+    current = peak = 0
+    if tracemalloc != None and tracemalloc.is_tracing():
+        current,peak = tracemalloc.get_traced_memory()
+        # before Python 3.9 the peak is the most used since the start
+        if hasattr(tracemalloc,"reset_peak"): tracemalloc.reset_peak()
+    elif resource != None:
+        current = peak = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss*1024
+    for most in measuring:
+        most[0] = max(most[0],peak)
+    return current,peak
+
+# This class keeps the time taken by each call of a stage, the memory the
+# call kept, and the most memory it used above that at its start.
+class Timer(object):
+
+    def __init__(self,name):
+        self.name = name
+        self.times = []
+        self.kept = [] # bytes
+        self.peaks = [] # bytes
+
+    # This function calls fcn, recording how long it took and the memory
+    # it used.
+    def time(self,fcn,*args):
+        before = memoryNow()[0]
+        most = [before]
+        measuring.append(most)
+        start = time.time()
+        try: result = fcn(*args)
+        finally: measuring.pop()
+        self.times.append(time.time()-start)
+        after,peak = memoryNow()
+        self.kept.append(after - before)
+        self.peaks.append(max(most[0],peak) - before)
+        return result
+
+    # This function returns a line of the report for this stage.
+    def report(self):
+        if self.times == []: return "%-14s %s" % (self.name,"not run")
+        times = sorted(self.times)
+        total = sum(times)
+        p95 = times[min(len(times)-1,int(len(times)*0.95))]
+        return ("%-14s %8d calls %9.3f ms mean %9.3f ms p95 "
+            "%9.3f ms max %9.2f s total %9.1f kB kept %9.1f kB peak") % (
+            self.name,len(times),1000*total/len(times),1000*p95,
+            1000*times[-1],total,sum(self.kept)/1e3,max(self.peaks)/1e3)
+
+# This class is the source of samples for the user interface: a
+# synthetic scanner run by the benchmark, not by a thread.
+class BenchSource(object):
+
+    def __init__(self,registry,args):
+        self.samples = sampleBuffer(1 << 16)
+        self.scanner = SyntheticScanner(registry,rate=args.rate,
+            decoys=args.decoys,dropout=args.dropout,realtime=False,
+            seed=args.seed)
+        self.scanner.withDelegate(ScanDelegate(registry,self.samples))
+
+    def start(self): pass
+
+    def stop(self): pass
+
+    # These functions match those of ScanGroup, for the metrics.
+
+    def counts(self):
+        delegate = self.scanner.delegate
+        return delegate.received,delegate.failed,delegate.lastHeard
+
+    def scanTimes(self):
+        return []
+
+    def health(self):
+        return []
+
+# This function returns a canvas to measure redrawAll with, or None if
+# there is no display.
+def makeCanvas(btpressure,data):
+    try:
+        root = btpressure.Tk()
+        canvas = btpressure.Canvas(root,width=data.width,height=data.height)
+        canvas.pack()
+        return canvas
+    except Exception:
+        return None
+
+# This function returns the memory in use, as text.
+def memory():
+    if tracemalloc != None:
+        current,peak = tracemalloc.get_traced_memory()
+        return "%.1f MB traced, %.1f MB peak" % (current/1e6,peak/1e6)
+    if resource != None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return "%.1f MB peak resident" % (peak/1e3)
+    return "unknown"
+
+# This function prints the throughput of the scan.
+def reportScan(args,source,timers):
+    scanned = source.scanner.elapsed*args.rate*(
+        len(source.scanner.sensors)+len(source.scanner.decoys))
+    if timers["scan"].times != []:
+        print("scan throughput: %.0f advertisements/s" % (
+            scanned/sum(timers["scan"].times)))
+
+# This function simulates a scan without the user interface, one timer
+# tick at a time, and reports the time taken by each stage.
+def benchScan(args,source,reason):
+    timers = dict((name,Timer(name)) for name in ("scan","drain","tick"))
+    ticks = int(args.minutes*60/args.tick)
+    def tick():
+        timers["scan"].time(source.scanner.process,args.tick)
+        timers["drain"].time(drain,source.samples)
+    for i in range(ticks):
+        timers["tick"].time(tick)
+    print("simulated %.0f minutes, %d ticks, %d sensors, %d decoys" % (
+        args.minutes,ticks,len(source.scanner.sensors),args.decoys))
+    for name in ("scan","drain","tick"):
+        print(timers[name].report())
+    reportScan(args,source,timers)
+    print("user interface not measured: %s" % reason)
+
+# This function simulates a run of the user interface, one timer tick at a
+# time, and reports the time taken by each stage.
+def benchInterface(args,source,btpressure,folder):
+    class Struct(object): pass
+    data = Struct()
+    data.width,data.height = 1600,800
+    btpressure.init(data,source)
+    data.fileName = os.path.join(folder,"bench.txt")
+    data.spacing = args.spacing
+    btpressure.start(data)
+    canvas = makeCanvas(btpressure,data)
+    names = ("scan","runScan","averagePoints","scaleGraphs","save",
+        "redrawAll","tick","process")
+    timers = dict((name,Timer(name)) for name in names)
+    ticks = int(args.minutes*60/args.tick)
+    spacingTicks = max(1,int(args.spacing*60/args.tick))
+    saveTicks = max(1,int(data.saveEvery*60/args.tick))
+    # the work of one call of timerFired
+    def tick(count):
+        timers["scan"].time(source.scanner.process,args.tick)
+        timers["runScan"].time(btpressure.runScan,data)
+        if count % spacingTicks == 0:
+            # the run clock is simulated, in minutes
+            data.lastTime = data.startTime + count*args.tick/60.0
+            timers["averagePoints"].time(btpressure.averagePoints,data)
+            timers["scaleGraphs"].time(btpressure.scaleGraphs,data)
+            data.dirty = True
+        if count % saveTicks == 0:
+            timers["save"].time(btpressure.save,data)
+        if canvas != None and data.dirty:
+            timers["redrawAll"].time(btpressure.redrawAll,canvas,data)
+            data.dirty = False
+    for count in range(1,ticks+1):
+        timers["tick"].time(tick,count)
+    data.running = False
+    timers["save"].time(btpressure.save,data)
+    data.writer.close()
+    timers["process"].time(btpressure.process,data)
+    print("simulated %.0f minutes, %d ticks, %d sensors, %d decoys" % (
+        args.minutes,ticks,len(source.scanner.sensors),args.decoys))
+    for name in names:
+        print(timers[name].report())
+    reportScan(args,source,timers)
+    if canvas == None: print("redrawAll not measured: no display")
+
+# This function runs the benchmark: of the user interface if Tkinter is
+# installed, and otherwise of the scan alone.
+def bench(args):
+    folder = tempfile.mkdtemp()
+    if tracemalloc != None: tracemalloc.start()
+    try:
+        source = BenchSource(loadRegistry(),args)
+        # the user interface needs Tkinter, which a headless box may lack
+        try: import btpressure
+        except ImportError as e: benchScan(args,source,e)
+        else: benchInterface(args,source,btpressure,folder)
+        print("memory: " + memory())
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == "__main__":
+    bench(parseArgs(sys.argv[1:]))
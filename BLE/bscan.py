@@ -11,101 +11,207 @@
 #   - add line "time.sleep(0.1)" after line 294 in doc
 #   - this is in class BluepyHelper, def _stopHelper first if statement
 
-from bluepy.btle import Scanner, DefaultDelegate
+# This file runs the bluetooth scan without a display, for rigs left
+# running for days. Every decoded sample is appended to a sample file as
+# a line of time (seconds since the epoch), MAC address, pressure, and
+# temperature, separated by commas. Nothing is kept in memory beyond the
+# samples of the current window.
+
+# To run:
+#   > sudo python bscan.py [sensors.csv] [-o samples.txt] [-a 0,1] [-v]
+#   - with more than one adapter, each scans in its own thread, and an
+#       advertisement heard by several adapters is only written once
+#   - stop with Ctrl-C or by killing the process
+#   - --log samples.bin also keeps every sample in a compact binary log,
+#       which can be exported to a run file with rawlog.py
+#   - --record raw.txt also saves the raw advertisements, which can be
+#       played back in place of the radio with --replay raw.txt
+#   - --simulate makes up sensors instead of scanning, for trying the
+#       system without sensors or root access (see simscan.py)
+#   - --metrics metrics.txt appends the acquisition metrics every minute:
+#       advertisements heard and undecodable per sensor, scan times, and
+#       how late each window is (see telemetry.py)
+#   - --feed also publishes the latest samples of each sensor in shared
+#       memory, for other processes to read live (see feed.py)
+#   - with TPMS_PROFILE=1 set, the time taken by each stage is kept,
+#       written with the --metrics and printed at the same time; kill
+#       -USR1 profiles the process for --profile-seconds, written next to
+#       the sample file (see profiling.py)
+#   - --send localhost:7070 also sends every window's samples to a
+#       collector gathering several rigs (see collect.py)
+# To view the samples live, run btpressure.py with the sample file:
+#   > python btpressure.py samples.txt
+
+import argparse
+import signal
 import time
-import struct
 import os
-
-#Enter the MAC address of the sensor from the lescan
-SENSOR_ADDRESS = ["80:ea:ca:10:07:11", "81:ea:ca:20:06:6a",
-                        "82:ea:ca:30:0b:9c","83:ea:ca:40:06:90"]
-SENSOR_LOCATION = ["TPMS1", "TPMS2","TPMS3","TPMS4"]
-
-# set 1
-# 1 - 80:ea:ca:10:02:dd
-# 2 - 81:ea:ca:20:00:b3
-# 3 - 82:ea:ca:30:01:ee
-# 4 - 83:ea:ca:40:01:00
-
-# set 2
-# 1 - 80:ea:ca:10:07:53
-# 2 - 81:ea:ca:20:05:36
-# 3 - 82:ea:ca:30:0c:f7
-# 4 - 83:ea:ca:40:0c:22
-
-# set 3
-# 1 - 80:ea:ca:10:06:1b
-# 2 - 81:ea:ca:20:06:33
-# 3 - 82:ea:ca:30:0b:ba
-# 4 - 83:ea:ca:40:08:25
-
-# set 4
-# 1 - 80:ea:ca:10:07:11
-# 2 - 81:ea:ca:20:06:6a
-# 3 - 82:ea:ca:30:0b:9c
-# 4 - 83:ea:ca:40:06:90
-
-class ScanDelegate(DefaultDelegate):
-    def __init__(self):
-        DefaultDelegate.__init__(self)
-
-    def handleDiscovery(self, dev, isNewDev, isNewData): pass
-
-def writeFile(path, contents):
-    with open(path, "wt") as f:
-        f.write(contents)
-
-def hexify(txt):
-    hx = ""
-    for i in range(len(txt)//2):
-        hx = txt[2*i] + txt[2*i+1] + hx
-    dec = int(hx, 16)
-    return dec
-
-def toPressure(dec): #return dec
-    slope = 0.000146885
-    yint = 0.626175
-    return round(dec*slope+yint,1)
-
-def toTemp(dec): #return dec
-    slope = 0.00977033
-    yint = 0.0214060
-    return round(dec*slope+yint,1)
-
-scanner = Scanner().withDelegate(ScanDelegate())
-
-
-ManuDataHex = []
-ReadLoop = True
-contents = ""
-start = time.time()
-while(True):
+import sys
+
+from acquire import ScanGroup, Recorder, drain, formatSample
+from tpms import loadRegistry, SENSOR_FILE
+from rawlog import LogWriter
+from telemetry import Telemetry
+from collect import Sender
+from schedule import Schedule
+from feed import FeedWriter, FEED_FILE
+from profiling import Profiler
+
+# This function reads the command line options.
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description="Record bluetooth pressure sensors without a display.")
+    parser.add_argument("registry",nargs="?",default=SENSOR_FILE,
+        help="file listing the sensors to record (default sensors.csv)")
+    parser.add_argument("-o","--out",default="samples.txt",
+        help="sample file to append to (default samples.txt)")
+    parser.add_argument("-a","--adapters",default="0",
+        help="comma separated adapter numbers to scan with (default 0)")
+    parser.add_argument("-w","--window",type=float,default=2.0,
+        help="seconds between writes to the sample file (default 2)")
+    parser.add_argument("-s","--sync",action="store_true",
+        help="wait for every write to reach the disk")
+    parser.add_argument("-v","--verbose",action="store_true",
+        help="print every sample")
+    parser.add_argument("-l","--log",
+        help="binary sample log to append to (see rawlog.py)")
+    parser.add_argument("--record",
+        help="file to append the raw advertisements to")
+    parser.add_argument("--replay",
+        help="play back a file of raw advertisements instead of scanning")
+    parser.add_argument("--speed",type=float,default=1.0,
+        help="recorded seconds played back per second (default 1)")
+    parser.add_argument("--simulate",action="store_true",
+        help="make up advertisements instead of scanning")
+    parser.add_argument("--rate",type=float,default=1.0,
+        help="simulated advertisements per second per device (default 1)")
+    parser.add_argument("--decoys",type=int,default=0,
+        help="number of simulated unrelated devices (default 0)")
+    parser.add_argument("--dropout",type=float,default=0.0,
+        help="chance a simulated advertisement is lost (default 0)")
+    parser.add_argument("-m","--metrics",
+        help="file to append the acquisition metrics to")
+    parser.add_argument("--metrics-every",type=float,default=60.0,
+        help="seconds between metrics (default 60)")
+    parser.add_argument("--feed",nargs="?",const=FEED_FILE,
+        help="publish the samples in shared memory (default %s)" % FEED_FILE)
+    parser.add_argument("--profile-seconds",type=float,default=60.0,
+        help="seconds profiled after SIGUSR1 (default 60)")
+    parser.add_argument("--send",
+        help="host:port or Unix socket of a collector to send samples to")
+    parser.add_argument("--name",
+        help="name of this rig at the collector (default the host name)")
+    return parser.parse_args(argv)
+
+# This function returns the function that makes the scanner of an
+# adapter: bluepy's Scanner, or a stand in from simscan.py.
+def scannerMaker(args,registry):
+    if args.replay != None:
+        from simscan import ReplayScanner
+        return lambda iface: ReplayScanner(args.replay,iface,args.speed)
+    if args.simulate:
+        from simscan import SyntheticScanner
+        return lambda iface: SyntheticScanner(registry,iface,args.rate,
+            args.decoys,args.dropout)
+    return None
+
+# This function prints a sample in the same form as the original scan.
+def printSample(registry,sample):
+    t,entry,pressure,temp = sample
+    label = registry.sensors[entry].label
+    print(label if label != "" else "TPMS" + str(entry+1))
+    print(time.strftime("%H:%M:%S",time.localtime(t)))
+    print("Pressure data: %s" % (str(pressure)))
+    print("Temperature data: %s" % (str(temp)))
+
+# This function prints the health of each adapter whose state changed
+# since the last call, and returns the states.
+def printHealth(scan,states):
+    current = []
+    for i,health in enumerate(scan.health()):
+        current.append(health["state"])
+        if i < len(states) and states[i] == health["state"]: continue
+        print("hci%d %s: %d failures, %d resets" % (health["iface"],
+            health["state"],health["failures"],health["resets"]))
+        if health["error"] != None: print("  " + health["error"])
+    return current
+
+# This function is run when the process is asked to stop, and ends the
+# scan the same way as Ctrl-C.
+def interrupt(signum,frame):
+    raise KeyboardInterrupt()
+
+# This function appends each sample of the window to the sample file.
+def writeSamples(registry,samples,out,verbose):
+    for sample in samples:
+        out.write(formatSample(registry,sample) + "\n")
+        if verbose: printSample(registry,sample)
+
+# This function scans until interrupted, appending each window's samples
+# to the sample file.
+def main(argv=None):
+    args = parseArgs(sys.argv[1:] if argv == None else argv)
+    registry = loadRegistry(args.registry)
+    signal.signal(signal.SIGTERM,interrupt)
+    ifaces = [int(iface) for iface in args.adapters.split(",")]
+    recorder = None if args.record == None else Recorder(args.record)
+    log = None if args.log == None else LogWriter(args.log,args.sync)
+    feed = None if args.feed == None else FeedWriter(registry,args.feed)
+    scan = ScanGroup(registry,ifaces,makeScanner=scannerMaker(args,registry),
+        recorder=recorder,log=log,feed=feed)
+    scan.start()
+    out = open(args.out, "at")
+    states = ["ok"]*len(ifaces)
+    # windows and metrics are due at whole multiples of their period from
+    # the start, on a monotonic clock
+    schedule = Schedule()
+    schedule.add("window",args.window)
+    if args.metrics != None: schedule.add("metrics",args.metrics_every)
+    profiler = Profiler.fromEnvironment()
+    telemetry = Telemetry(registry,scan,schedule,profiler)
+    sender = None if args.send == None else Sender(args.send,registry,
+        args.name)
+    if hasattr(signal,"SIGUSR1"):
+        signal.signal(signal.SIGUSR1,lambda signum,frame:
+            profiler.startProfile(args.profile_seconds,
+                os.path.splitext(args.out)[0]))
     try:
-        devices = scanner.scan(2.0)
-        ManuData = ""
-        for dev in devices:
-            entry = 0
-            for saddr in SENSOR_ADDRESS:
-                entry += 1
-                if (dev.addr == saddr):
-                    for (adtype, desc, value) in dev.getScanData():
-                        if (desc == "Manufacturer"): ManuData = value
-                    if (ManuData == ""): continue
-                    pressure = toPressure(hexify(ManuData[16:24]))
-                    temp = toTemp(hexify(ManuData[24:32]))
-                    tim = round(time.time()-start,1)
-                    contents += str(tim) + " " + str(pressure) + "\n"
-
-                    print(SENSOR_LOCATION[entry-1])
-                    print(time.strftime("%H:%M:%S"))
-                    print("Pressure data: %s" % (str(pressure)))
-                    print("Temperature data: %s" % (str(temp)))
-
+        while True:
+            time.sleep(schedule.wait())
+            if schedule.due("metrics"):
+                telemetry.dump(args.metrics)
+                for line in profiler.lines(): print(line)
+            if not schedule.due("window"): continue
+            profiler.poll()
+            with profiler.work():
+                samples = drain(scan.samples)
+                with profiler.span("write"):
+                    telemetry.time("write",writeSamples,registry,samples,
+                        out,args.verbose)
+                if sender != None:
+                    with profiler.span("send"):
+                        telemetry.time("send",sender.send,samples)
+                with profiler.span("flush"):
+                    out.flush()
+                    if args.sync: os.fsync(out.fileno())
+                    if log != None: log.flush()
+                states = printHealth(scan,states)
     except KeyboardInterrupt:
-        writeFile("test.txt",contents)
+        scan.stop()
+        scan.join(args.window + 1)
+        # writes whatever arrived during the last window
+        samples = drain(scan.samples)
+        writeSamples(registry,samples,out,False)
+        out.close()
+        if sender != None:
+            sender.send(samples)
+            sender.close()
+        if args.metrics != None: telemetry.dump(args.metrics)
+        if recorder != None: recorder.close()
+        if log != None: log.close()
+        if feed != None: feed.close()
+        profiler.close()
         print("written")
-        break
-    # except:
-    #     os.popen("sudo hciconfig hci0 reset")
-        
 
+if __name__ == "__main__":
+    main()
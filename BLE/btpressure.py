@@ -25,6 +25,12 @@
 # To run program:
 #   > sudo python btpressure.py
 #   - the sudo command is needed as the bluetooth scan requires root access
+#   - the sensors to scan for, with their channel, label, and calibration,
+#       are listed in sensors.csv
+# To view a scan run by bscan.py instead of scanning:
+#   > python btpressure.py samples.txt
+#   - samples.txt is the sample file written by bscan.py; root access is
+#       not needed, and closing the window does not stop the scan
 # In program:
 #   - file name and individual labels can only be updated when the program is
 #       not running
@@ -37,46 +43,71 @@
 #   - when the run is stopped, the data will be written to the file
 #       and processed such that all intermediate data points with no
 #       collected value are given one by linear interpolation
+#   - with data.columnar set in init, the points are also written as typed
+#       columns to a .cols file next to the data file, for loading into
+#       numpy or pandas without parsing (see columns.py)
+#   - press m when not editing to show or hide the acquisition metrics:
+#       advertisements heard and undecodable per sensor, scan times, how
+#       late and how often missed the points, saves, and other scheduled
+#       work are, and the time taken to save and redraw. The
+#       metrics are also appended to a .metrics file next to the data file
+#       at every save
+#   - with TPMS_PROFILE=1 set, the time taken by each stage is kept in
+#       histograms shown with the metrics, and with TPMS_TRACE=trace.json
+#       each call is also written to a trace file. Press p when not
+#       editing to profile the program for a minute, written next to the
+#       data file (see profiling.py)
+#   - press l when not editing to show or hide the lifetime of each
+#       dataset: the decay fitted to the logarithm of its raw pressures,
+#       within the baseline bounds once they are set. The fit is updated
+#       as each point is added
 
 
-from bluepy.btle import Scanner, DefaultDelegate
 import time
-import struct
+import math
 from Tkinter import *
 from tkcolorpicker import askcolor
 import tkMessageBox
 import os,subprocess
+import sys
 
-# file reading/writing from 15-112: 
-# http://www.kosbie.net/cmu/spring-16/15-112/notes/
-#       notes-strings.html#basicFileIO
-
-def readFile(path):
-    with open(path, "rt") as f:
-        return f.read()
-
-def writeFile(path, contents):
-    with open(path, "wt") as f:
-        f.write(contents)
+from acquire import ScanGroup, FollowThread, drain
+from tpms import loadRegistry
+from runfile import RunWriter, processFile
+from series import SeriesStore, OffsetStore, RunningStats, LogFit
+from telemetry import Telemetry
+from schedule import Schedule
+from columns import ColumnWriter
+from profiling import Profiler
 
 ####################################
 # Graph Class 
 ####################################
 
-# This class defines a graph object, and draws it.
+# This class defines a graph object, and draws it. The canvas items of a
+# graph are kept between redraws: only new points are added, and the
+# points are only redrawn when the limits of the graph change.
 class Graph(object):
+    count = 0 # graphs made, for unique canvas tags
 
     def __init__(self,xlim,ylim,xaxis,yaxis,points,title,coord):
         self.xlim = xlim # bounds on x data
         self.ylim = ylim # bounds on y data
         self.xaxis = xaxis # x axis label
         self.yaxis = yaxis # y axis label
-        self.points = points # data points
+        self.points = points # data points, as a Series
         self.title = title # graph title
         self.coord = coord # tkinter graph space edges
         self.margin = 20
         self.limits() # tkinter graph edges
         self.scales() # conversion from data to tkinter space
+        # canvas items, created on first draw
+        Graph.count += 1
+        self.tag = "graph" + str(Graph.count) # on all items of the graph
+        self.created = False
+        self.plots = [] # drawn points of each dataset
+        self.colors = [] # drawn color of each dataset
+        self.rescaled = True # whether points must be redrawn
 
     # This function determines the edges of the graph in the given
     # tkinter space.
@@ -112,7 +143,8 @@ class Graph(object):
 
     # This function adds a new point to the data points.
     def addPoint(self,point):
-        self.points.append(point)
+        x,y = point
+        self.points.add(x,y)
 
     # This function updates the x and y limits of the data,
     # changing the scaling factor.
@@ -120,10 +152,11 @@ class Graph(object):
         self.xlim = xlim
         self.ylim = ylim
         self.scales()
+        self.rescaled = True
 
     # This function determines if a graph is empty.
     def isEmpty(self):
-        return self.points == []
+        return len(self.points) == 0
 
     # This function checks if a coordinate point is within 
     # the graph space.
@@ -131,44 +164,26 @@ class Graph(object):
         return (self.axisLimits[0] < x < self.axisLimits[2] and
             self.axisLimits[1] < y < self.axisLimits[3])
 
-    # This function makes a log graph from a linear graph.
-    def makeLogGraph(self, data):
-        # This function checks if a point is within bounds.
-        def inBound(point):
-            x,y = point
-            # if the bound isn't set, all points are in
-            if data.bound[0] != None:
-                if data.lb > x: return False
-            if data.bound[1] != None:
-                if data.ub < x: return False
-            return True
-        # This function gets the correct value out of a tuple.
-        def getTuple(point,idx):
-            return point[idx]
-        # This function checks if a value is None.
-        def notNone(point):
-            x,y = point
-            return y != None
-        # gets the points in the log graph
-        points = filter(notNone, map(yLog, filter(inBound,self.points)))
-        ys = map(lambda x: getTuple(x,1), points)
-        xs = map(lambda x: getTuple(x,0), points)
-        ylow,xlow = min(ys),min(xs)
-        yup,xup = max(ys),max(xs)
-        # finds the lifetime of the data
-        linReg(data,xs,ys)
-        return Graph((xlow,xup),(ylow,yup),self.xaxis,self.yaxis,points,
-            self.title,self.coord)
-
     # This function draws the graph.
     def drawGraph(self,canvas):
-        canvas.create_rectangle(self.axisLimits,fill="white")
-        self.drawAxes(canvas)
+        if not self.created: self.createItems(canvas)
+        if self.rescaled:
+            self.drawAxes(canvas)
+            self.clearPoints(canvas)
+            self.rescaled = False
         self.drawPoints(canvas)
+
+    # This function creates the canvas items that do not depend on the
+    # data: the graph space, grid lines, and labels.
+    def createItems(self,canvas):
+        canvas.create_rectangle(self.axisLimits,fill="white",tags=self.tag)
+        self.createAxes(canvas)
         self.drawLabels(canvas)
+        self.created = True
 
-    # This function draws the graph axes, with numberings.
-    def drawAxes(self,canvas):
+    # This function creates the graph axes, with empty numberings.
+    def createAxes(self,canvas):
+        self.yTicks,self.xTicks = [],[]
 
         # y axes, in volts
         xl,yl,xu,yu = self.axisLimits
@@ -177,11 +192,9 @@ class Graph(object):
         for i in range(5):
             x1,y1 = xl,yl+i*(yu-yl)/4.0
             x2,y2 = xu,yl+i*(yu-yl)/4.0
-            # determines graph marking
-            val = round(self.ylim[1]-(self.ylim[1]-self.ylim[0])/4.0*i,2)
-            canvas.create_line(x1,y1,x2,y2)
-            canvas.create_text(self.axisLimits[0]-5,y2,
-                anchor="e",text=str(val),font=font)
+            canvas.create_line(x1,y1,x2,y2,tags=self.tag)
+            self.yTicks.append(canvas.create_text(self.axisLimits[0]-5,y2,
+                anchor="e",font=font,tags=self.tag))
         
         # x axes, in ns
         xl,yl,xu,yu = self.axisLimits
@@ -189,20 +202,29 @@ class Graph(object):
         for i in range(5):
             x1,y1 = xl+i*(xu-xl)/4.0,yl
             x2,y2 = xl+i*(xu-xl)/4.0,yu
-            # determines graph marking
+            canvas.create_line(x1,y1,x2,y2,tags=self.tag)
+            self.xTicks.append(canvas.create_text(x2,y2+20,anchor="n",
+                font=font,tags=self.tag))
+
+    # This function numbers the graph axes for the current limits.
+    def drawAxes(self,canvas):
+        for i in range(5):
+            # determines graph markings
+            val = round(self.ylim[1]-(self.ylim[1]-self.ylim[0])/4.0*i,2)
+            canvas.itemconfig(self.yTicks[i],text=str(val))
             val = round((self.xlim[0]+(self.xlim[1]-self.xlim[0])/4.0*i),2)
-            canvas.create_line(x1,y1,x2,y2)
-            canvas.create_text(x2,y2+20,anchor="n",text=str(val),
-                font=font)
+            canvas.itemconfig(self.xTicks[i],text=str(val))
 
-    # This function draws the points on the graph.
+    # This function draws the points added since the last draw.
     def drawPoints(self,canvas):
-        for point in self.points:
-            x,y = self.getCoord(point)
-            if y == None: continue
-            x1,y1 = x-2,y-2
-            x2,y2 = x+2,y+2
-            canvas.create_oval(x1,y1,x2,y2,fill="black")
+        if self.plots == []: self.plots.append(Plot(self.tag))
+        self.plots[0].draw(canvas,self,self.points,dict(fill="black"))
+
+    # This function removes all drawn points, so that they are drawn
+    # again for the current limits.
+    def clearPoints(self,canvas):
+        canvas.delete(self.tag + "-points")
+        self.plots = []
 
     # This function draws the graph labels.
     def drawLabels(self,canvas):
@@ -210,52 +232,103 @@ class Graph(object):
         # Arial 10,8 for low_res
         font1 = "Arial 12 bold"
         font2 = "Arial 10 bold"
-        canvas.create_text((x2-x1)/2+x1,y1+5,text=self.title,font=font1)
-        canvas.create_text((x2-x1)/2+x1,y2-5,text=self.xaxis,font=font2)
-        canvas.create_text(x1+5,(y2-y1)/2+y1,text=self.yaxis,font=font2)
+        canvas.create_text((x2-x1)/2+x1,y1+5,text=self.title,font=font1,
+            tags=self.tag)
+        canvas.create_text((x2-x1)/2+x1,y2-5,text=self.xaxis,font=font2,
+            tags=self.tag)
+        canvas.create_text(x1+5,(y2-y1)/2+y1,text=self.yaxis,font=font2,
+            tags=self.tag)
+
+# This class draws a dataset on a graph with at most two points in each
+# pixel column: the lowest and the highest. However long the run, the
+# number of drawn points is limited by the width of the graph. The columns
+# are kept until the graph limits change and the dataset is drawn again.
+class Plot(object):
+
+    def __init__(self,tag,idx=0):
+        # tags of the drawn points: the graph, all of its points, and
+        # this dataset
+        self.tags = (tag,tag + "-points",tag + "-" + str(idx))
+        self.drawn = 0 # points of the dataset seen so far
+        # pixel column -> [top y,bottom y,top oval,bottom oval]
+        self.columns = dict()
+
+    # This function draws the points of the dataset added since the last
+    # draw, with the given oval style.
+    def draw(self,canvas,graph,points,style):
+        for point in points.pointsFrom(self.drawn):
+            self.drawn += 1
+            x,y = graph.getCoord(point)
+            box = x-2,y-2,x+2,y+2
+            column = self.columns.get(int(x))
+            if column == None:
+                oval = canvas.create_oval(box,tags=self.tags,**style)
+                self.columns[int(x)] = [y,y,oval,oval]
+            elif y < column[0]: # above the highest point
+                column[0] = y
+                column[2] = self.place(canvas,column,2,box,style)
+            elif y > column[1]: # below the lowest point
+                column[1] = y
+                column[3] = self.place(canvas,column,3,box,style)
+
+    # This function moves one end of a column to a new point. If the
+    # column has a single oval, it stays as the other end.
+    def place(self,canvas,column,idx,box,style):
+        if column[2] == column[3]:
+            return canvas.create_oval(box,tags=self.tags,**style)
+        canvas.coords(column[idx],box)
+        return column[idx]
 
 # This class updates the graph class to allow for multiple datasets on
 # the same plot, as well as functionalities for use on a normalized graph.
+# Its points are a SeriesStore, with one Series per dataset. The points of
+# a normalized graph are an OffsetStore over the points of the raw graph.
 class Multigraph(Graph):
 
     # This function updates the addPoint fcn in the graph class to work
     # on a multigraph: adding a point to the proper dataset.
     def addPoint(self,point,idx):
-        while len(self.points) <= idx:
-            self.points.append([])
-        self.points[idx].append(point)
+        self.points.add(idx,point)
+
+    # This function determines if a graph is empty.
+    def isEmpty(self):
+        return self.points.isEmpty()
 
     # This function removes the given points from a given dataset.
     def removePoints(self,i,points):        
-        for item in points[::-1]:
-            self.points[i].pop(item)
+        self.points[i].remove(points)
+        self.rescaled = True
 
     # This function shifts all points in the graph based on a specified 
-    # baseline, where one baseline is provided per dataset.
+    # baseline, where one baseline is provided per dataset. The points
+    # are shifted as they are read, so only the baselines are stored.
     def shiftPoints(self,baseline):
-        for i in range(len(baseline)):
-            if baseline[i] == 0: continue
-            self.points[i] = map(lambda (x,y): (x,y - baseline[i]),
-                self.points[i])
+        self.points.setOffsets(baseline)
+        self.rescaled = True
 
     # This function modifies the drawPoints fcn to draw multiple
-    # datasets with specified colors.
+    # datasets with specified colors. The points of each dataset share a
+    # tag, so a change of color is a single update.
     def drawPoints(self,canvas,data):
+        while len(self.plots) < len(self.points):
+            self.plots.append(Plot(self.tag,len(self.plots)))
+        while len(self.colors) < len(self.points):
+            self.colors.append(None)
         for i in range(len(self.points)):
-            for point in self.points[i]:
-                x,y = self.getCoord(point)
-                if y == None: continue
-                x1,y1 = x-2,y-2
-                x2,y2 = x+2,y+2
-                canvas.create_oval(x1,y1,x2,y2,fill=data.color[i],
-                    outline=data.color[i])
+            style = dict(fill=data.color[i],outline=data.color[i])
+            if self.colors[i] != data.color[i]:
+                canvas.itemconfig(self.tag + "-" + str(i),**style)
+                self.colors[i] = data.color[i]
+            self.plots[i].draw(canvas,self,self.points[i],style)
 
     # This function draws the graph, and includes passing data to drawPoints.
     def drawGraph(self,canvas,data):
-        canvas.create_rectangle(self.axisLimits,fill="white")
-        self.drawAxes(canvas)
+        if not self.created: self.createItems(canvas)
+        if self.rescaled:
+            self.drawAxes(canvas)
+            self.clearPoints(canvas)
+            self.rescaled = False
         self.drawPoints(canvas,data)
-        self.drawLabels(canvas)
 
 # This class defines a selectable button object with rectangle, text, and
 # event properties specific to the object.
@@ -279,6 +352,9 @@ class Icon(object):
         self.tFill = textSpecs[4]
         # function to run when button is pressed
         self.fcn = fcn
+        # canvas items and their drawn fill, text, and text color
+        self.items = None
+        self.shown = None
 
     # This function updates the fill color of the button.
     def updateFill(self,fill):
@@ -301,54 +377,33 @@ class Icon(object):
         # if not function has been specified, nothing happens
         if self.fcn != None: self.fcn(self,data)
 
-    # This function draws the button with text.
+    # This function draws the button with text, updating the existing
+    # items if the button has been drawn before.
     def drawIcon(self,canvas):
-        canvas.create_rectangle(self.left,self.top,self.right,self.bot,
-            fill=self.fill)
-        canvas.create_text(self.tLeft,self.tTop,text=self.text,
-            anchor=self.anchor,font=self.font,fill=self.tFill)
-
-# This class determines the interaction between the device and the 
-# BLE sensor. The current settings do not include print statemtents for
-# discovering new devices.
-class ScanDelegate(DefaultDelegate):
-    def __init__(self):
-        DefaultDelegate.__init__(self)
-
-    def handleDiscovery(self, dev, isNewDev, isNewData): pass
-
-# This function splits a string hex number into a decimal number.
-def hexify(txt):
-    hx = ""
-    for i in range(len(txt)//2):
-        hx = txt[2*i] + txt[2*i+1] + hx
-    dec = int(hx, 16)
-    return dec
-
-# This function converts a sensor value to a pressure value (PSI) based
-# on manual calibration.
-def toPressure(dec):
-    slope = 0.000146885
-    yint = 0.626175
-    return round(dec*slope+yint,1)
-
-# This function converts a sensor value to a temperature value (C) based
-# on manual calibration.
-def toTemp(dec):
-    slope = 0.00977033
-    yint = 0.0214060
-    return round(dec*slope+yint,1)
+        shown = self.fill,self.text,self.tFill
+        if self.items == None:
+            self.items = (canvas.create_rectangle(self.left,self.top,
+                    self.right,self.bot,fill=self.fill),
+                canvas.create_text(self.tLeft,self.tTop,text=self.text,
+                    anchor=self.anchor,font=self.font,fill=self.tFill))
+        elif shown != self.shown:
+            rect,text = self.items
+            canvas.itemconfig(rect,fill=self.fill)
+            canvas.itemconfig(text,text=self.text,fill=self.tFill)
+        self.shown = shown
 
 ##########################################
 # UI
 ##########################################
 
 # This function defines the graph specifications for a pressure vs. time
-# graph with not datasets or points initially.
-def emptyGraph(data,coords,title):
+# graph with not datasets or points initially. A graph of the points of
+# another graph can be made by passing those points.
+def emptyGraph(data,coords,title,points=None):
+    if points == None: points = SeriesStore(data.channels)
     # xlim,ylim,xaxis,yaxis,points,title,coord
-    return Multigraph((0,20),(0,16),"time (min)","pressure (psi)",[],
-        title,coords)
+    return Multigraph((0,20),(0,16),"time (min)","pressure (psi)",
+        points,title,coords)
 
 # This function returns functions specific to the button pressed, for
 # the icons containing editable text.
@@ -406,35 +461,68 @@ def buttonIcon(idx,data):
 # This function starts the run if no veto is received.
 def start(data): 
     # checks to see if a file of this name already exists
-    if isValidFile(data.fileName) and readFile(data.fileName) != "":
+    if isValidFile(data.fileName) and os.path.getsize(data.fileName) > 0:
         # if so, confirmation to continue is required from the user
         cont = tkMessageBox.askyesno("Question",
                 "A file with this name already exists. Continue anyway?")
         if not cont: return False
+    # the files of the run are opened before anything of the run changes,
+    # and the run is not started if one cannot be, such as a column file
+    # of other datasets
+    writer = columns = None
+    try:
+        # the output file stays open for the run, and is appended to
+        writer = RunWriter(data.fileName,header(data),sync=data.sync)
+        if data.columnar:
+            columns = ColumnWriter(os.path.splitext(data.fileName)[0]
+                + ".cols",columnMeta(data))
+    except (IOError,OSError,ValueError) as e:
+        if writer != None: writer.close()
+        data.error = str(e)
+        return False
+    data.error = ""
     # starts run and notifies calling function of success
-    data.running = True
     initTest(data)
+    data.writer,data.columns = writer,columns
+    # the metadata of the new run, now that it has started
+    if columns != None: columns.setMeta(columnMeta(data))
+    data.running = True
+    # points and saves are due at whole multiples of their period from
+    # the start of the run
+    data.runStart = data.schedule.clock()
+    data.schedule.add("point",data.spacing*data.convert,data.runStart)
+    data.schedule.add("save",data.saveEvery*data.convert,data.runStart)
+    data.metricsFile = os.path.splitext(data.fileName)[0] + ".metrics"
     return True
 
 # This function stops the run, saves the data, and processes the data.
 def stop(data): 
     data.running = False
+    data.schedule.remove("point")
+    data.schedule.remove("save")
     save(data)
-    process(data)
+    data.writer.close()
+    if data.columns != None:
+        data.columns.close()
+        data.columns = None
+    data.telemetry.dump(data.metricsFile)
+    with data.profiler.span("process"): process(data)
 
 # This function initializes all name icons for the datasets.
 def initNameIcons(data):
-    bwidth = data.width/3/5
+    # 2 rows of names, with at least 8 names per row
+    cols = max(8,(data.channels+1)/2)
+    bwidth = data.width/3/5*8/cols
     bheight = data.height/4/5
-    # 2x8 grid of names
     for row in range(2):
-        for col in range(8):
+        for col in range(cols):
             # location of button
             left = data.width/6 + bwidth/5 * (col + 1) + bwidth * col
             right = left + bwidth
             top = data.height*3/4 + bheight/5 * (row + 1) + bheight * row
             bottom = top + bheight
-            idx = row*8 + col
+            idx = row*cols + col
+            if idx >= data.channels: break
             # labels button appropriately
             text = str(idx + 1) + ": " + data.label[idx]
             font = "Arial %d bold" % (bheight/4)
@@ -449,12 +537,12 @@ def initNameIcons(data):
 def initLegendIcons(data):
     vTop = 2*data.margin
     vBot = data.height*3/4
-    bheight = (vBot-vTop-15*(data.margin/2))/16
+    bheight = (vBot-vTop-(data.channels-1)*(data.margin/2))/data.channels
     left = data.width-4.5*data.margin
     right = data.width-3.5*data.margin
     # includes low_res and high_res font options
     font = "Arial 10 bold" if data.width == 1600 else "Arial 8 bold"
-    for i in range(16):
+    for i in range(data.channels):
         top = vTop+(data.margin/2+bheight)*i
         coords = left,top,right,top+bheight
         # uses specified color for dataset
@@ -515,73 +603,92 @@ def color(val):
     if val: return "red"
     else: "black"
 
-# This function creates a length 16 list of empty lists.
-def emptyList():
-    return [[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[]]
+# This function creates a list of empty running statistics, one per
+# dataset.
+def emptyStats(data):
+    return [RunningStats() for i in range(data.channels)]
 
 # This function resets variables to their initial values at the 
 # beginning of each run.
 def initTest(data):
     # baseline information
-    data.baseline = [0]*16
-    data.basetemp = [0]*16
+    data.baseline = [0]*data.channels
+    data.basetemp = [0]*data.channels
     data.lb = None
     data.ub = None
     # collected values between display points
-    data.midPoints = emptyList()
-    data.midTemps = emptyList()
+    data.midPoints = emptyStats(data)
+    data.midTemps = emptyStats(data)
+    # log-linear fit of each dataset, within the baseline bounds
+    data.fits = [LogFit() for i in range(data.channels)]
     # graphs
     data.rawGraph = emptyGraph(data,(2*data.margin,data.margin,
         data.width/2-3*data.margin,data.height*3/4-data.margin),"Raw Data")
     data.normGraph = emptyGraph(data,(data.width/2-2*data.margin,
         data.margin,data.width-7*data.margin,data.height*3/4-data.margin),
-            "Normalized Data")
+            "Normalized Data",OffsetStore(data.rawGraph.points))
     # displayed pressure and temperature
-    data.pressures = [""] * 16
-    data.temps = [""] * 16
+    data.pressures = [""] * data.channels
+    data.temps = [""] * data.channels
     # graph scaling observance
     data.highPoint = 0
     # timing information
     data.startTime = time.time()/data.convert
     data.lastTime = time.time()/data.convert
-    data.lastSave = time.time()/data.convert
 
 # This function initializes all data for the user interface when the file is
-# started.
-def init(data):
+# started. Samples come from source if one is given, such as a scanner
+# from simscan.py, and otherwise from the radio or the sample file of
+# bscan.py.
+def init(data,source=None):
     # BLE communication
-    data.scanner = Scanner().withDelegate(ScanDelegate())
-    data.sAddr = ["80:ea:ca:10:02:dd","81:ea:ca:20:00:b3",
-                  "82:ea:ca:30:01:ee","83:ea:ca:40:01:00",
-                  "80:ea:ca:10:07:53","81:ea:ca:20:05:36",
-                  "82:ea:ca:30:0c:f7","83:ea:ca:40:0c:22",
-                  "80:ea:ca:10:06:1b","81:ea:ca:20:06:33",
-                  "82:ea:ca:30:0b:ba","83:ea:ca:40:08:25",
-                  "80:ea:ca:10:07:11","81:ea:ca:20:06:6a",
-                  "82:ea:ca:30:0b:9c","83:ea:ca:40:06:90"]
+    data.registry = loadRegistry()
+    data.channels = len(data.registry)
+    data.adapters = [0] # bluetooth adapters to scan with, as in hci0
     # color-blind friendly colors
     data.color = ["#3CA4BB","#BE1E1E","#E9E610","#09BB0C",
                   "#030100","#131178","#E23D95","#5ECA92",
                   "#FF9203","white","white","white",
                   "white","white","white","white"]
+    data.color += ["white"] * (data.channels - len(data.color))
     # user interface display settings
     data.margin = data.width/80
-    data.label = [""]*16
     data.convert = 60 # seconds to minutes
-    # temporary values for testing purposes
-    data.label = ["one","two","three","four","five","six","seven","eight",
-                  "nine","ten","eleven","twelve","","","",""]
-    
+    # dataset names, where unnamed datasets are not recorded
+    data.label = data.registry.labels()
+
     initTest(data)
+    # follows the sample file of bscan.py if given one, or else scans
+    if source != None: data.scanThread = source
+    elif len(sys.argv) > 1:
+        data.scanThread = FollowThread(data.registry,sys.argv[1])
+    else: data.scanThread = ScanGroup(data.registry,data.adapters)
+    data.scanThread.start()
+    # deadlines of the user interface, in seconds; the deadlines of a run
+    # are added when it starts
+    data.schedule = Schedule()
+    data.schedule.add("collect",1.0) # samples are taken from the scan
+    data.schedule.add("blink",0.5) # pipe symbol of the edited text
+    data.schedule.add("refresh",1.0) # shown metrics
+    # timing spans and profiles, set up by the environment
+    data.profiler = Profiler.fromEnvironment()
+    data.telemetry = Telemetry(data.registry,data.scanThread,data.schedule,
+        data.profiler)
+    data.showMetrics = False
+    data.showLifetimes = False
+    data.profileSeconds = 60
 
     # information for collecting and saving data
     data.fileName = "test.txt"
     data.newData = ""
     data.spacing = 3
+    data.saveEvery = 5 # minutes between saves
+    data.sync = True # saves wait until the data is on disk
+    data.columnar = False # whether to also write a column file
+    data.columns = None # ColumnWriter of the run, if columnar
     data.filler = "None"
     # editing data
     data.editing = None
-    data.time = 0
     data.pipe = False
     data.editText = ""
     data.error = ""
@@ -589,6 +696,12 @@ def init(data):
     data.bound = None
     data.basing = None
     data.running = False
+    # drawing data: canvas items are made on the first redraw, and the
+    # user interface is only redrawn when something has changed
+    data.canvasItems = None
+    data.shownText = dict()
+    data.shownGraphs = []
+    data.dirty = True
 
     initIcons(data)
 
@@ -597,18 +710,20 @@ def init(data):
 def addBaseline(data):
     # for each dataset, the baseline is calculated
     for i in range(len(data.rawGraph.points)):
-        avg = []
         # averages over all points of the dataset within user time bound
-        for j in range(len(data.rawGraph.points[i])):
-            if data.lb <= data.rawGraph.points[i][j][0] <= data.ub:
-                avg.append(data.rawGraph.points[i][j][1])
-        data.baseline[i] = average(avg)
+        avg = data.rawGraph.points[i].mean(data.lb,data.ub)
+        data.baseline[i] = 0 if avg == None else round(avg,1)
     # sets the normalized graph to display baseline as zero
     data.normGraph.shiftPoints(data.baseline)
+    # fits each dataset again within the bounds
+    for i in range(len(data.rawGraph.points)):
+        data.fits[i].refit(data.rawGraph.points[i].between(data.lb,data.ub),
+            data.lb,data.ub)
     # updates displayed pressure data by new baseline
     for i in range(len(data.pressures)):
         if data.pressures[i] == "": continue
-        data.pressures[i] = str(float(data.pressures[i]) - data.baseline[i])
+        data.pressures[i] = (data.rawGraph.points[i].values[-1] -
+            data.baseline[i])
 
 # This function reacts to user clicks in the user interface.
 def mousePressed(event, data):
@@ -658,11 +773,16 @@ def keyPressed(event, data):
                 except: pass
             elif data.editText == "time":
                 num = data.editing.text.split(" ")[-1].strip("|")
-                try: # makes sure a float has been entered
+                try: # makes sure a positive float has been entered
+                    if float(num) <= 0: raise ValueError(num)
                     data.spacing = float(num)
+                    # the next points are spaced from the last one
+                    if "point" in data.schedule:
+                        data.schedule["point"].setPeriod(
+                            data.spacing*data.convert)
                     clearEdit(data)
                 except: pass
-            elif data.editText in map(str,range(16)):
+            elif data.editText in map(str,range(data.channels)):
                 data.label[int(data.editText)] = (
                     data.editing.text.split(" ")[-1].strip("|"))
                 clearEdit(data)
@@ -674,6 +794,13 @@ def keyPressed(event, data):
         else:
             data.editing.updateText(data,
                 data.editing.text.strip("|") + event.char)
+    # shows or hides the acquisition metrics and lifetimes
+    elif event.char == "m": data.showMetrics = not data.showMetrics
+    elif event.char == "l": data.showLifetimes = not data.showLifetimes
+    # profiles the program for a while
+    elif event.char == "p":
+        data.profiler.startProfile(data.profileSeconds,
+            os.path.splitext(data.fileName)[0])
 
 # These functions determine if a path is a valid folder or file.
 
@@ -697,45 +824,24 @@ def piping(data,text):
     elif "|" in text: return text.strip("|")
     else: return text
 
-# This function runs the bluetooth scan.
+# This function collects the samples decoded by the scan thread since the
+# last timer tick. Samples are only kept if they arrived during the run.
 def runScan(data):
-    try: # scans for BLE sensors
-        devices = data.scanner.scan(2.0)
-        ManuData = ""
-        for dev in devices:
-            entry = 0
-            # checks if data is wanted from found sensors
-            for saddr in data.sAddr:
-                if (dev.addr == saddr):
-                    # collects pressure and temperature data from sensor
-                    for (adtype, desc, value) in dev.getScanData():
-                        if (desc == "Manufacturer"): ManuData = value
-                    if (ManuData == ""): continue
-                    pressure = toPressure(hexify(ManuData[16:24]))
-                    temp = toTemp(hexify(ManuData[24:32]))
-                    # includes new data in averaging
-                    data.midPoints[entry].append(pressure)
-                    data.midTemps[entry].append(temp)
-                entry += 1
-    # if scan fails, reopens bluetooth connection
-    except: os.popen("sudo hciconfig hci0 reset")
-
-# This function returns the average of a list of numbers.
-def average(lst):
-    if lst == []: return None
-    total = 0
-    for i in range(len(lst)):
-        total += lst[i]
-    return round(total/(len(lst)),1)
+    for (t,entry,pressure,temp) in drain(data.scanThread.samples):
+        if not data.running or t/data.convert < data.startTime: continue
+        # includes new data in averaging
+        data.midPoints[entry].add(pressure)
+        data.midTemps[entry].add(temp)
 
 # This function generates the next points in each dataset by averaging
 # all points found since last generation. Then it updates the graphs and
 # user interface to display this information. It also stores the gathered
 # information to be saved later.
 def averagePoints(data):
+    points = [] # (pressure,temp) of each named dataset, for the columns
     for i in range(len(data.midPoints)):
-        avg = average(data.midPoints[i])
-        temp = average(data.midTemps[i])
+        avg = data.midPoints[i].average()
+        temp = data.midTemps[i].average()
         # adds the time to the front of the new line of data to write
         if i == 0: data.newData += "\n" + str(
             round(data.lastTime-data.startTime,2))
@@ -743,19 +849,26 @@ def averagePoints(data):
         if data.label[i] != "": 
             if avg == None: # no data was received during the timeframe
                 data.newData += "," + data.filler + "," + data.filler
+                points.append(None)
             else:
                 # adds points to graphs
                 if avg > data.highPoint: data.highPoint = avg
+                # the normalized graph shows the same points
                 data.rawGraph.addPoint((data.lastTime-data.startTime,avg),i)
+                data.fits[i].add(data.lastTime-data.startTime,avg)
                 norm = avg - data.baseline[i]
-                data.normGraph.addPoint((data.lastTime-data.startTime,norm),i)
                 # records pressure and temperature data to write out
                 data.newData += "," + str(avg) + "," + str(temp)
+                points.append((avg,temp))
                 data.pressures[i] = norm
                 data.temps[i] = temp
         else: continue
+    if data.columns != None:
+        data.columns.add(round(data.lastTime-data.startTime,2),points)
     # resets recorded points for next timeframe
-    data.midPoints = emptyList()
+    for i in range(data.channels):
+        data.midPoints[i].reset()
+        data.midTemps[i].reset()
 
 # This function scales the graphs to incorporate points outside of 
 # the graph limits. The graphs are scaled so that the new points appear
@@ -784,137 +897,196 @@ def scaleGraphs(data):
             data.normGraph.updateLimits(data.normGraph.xlim,
                 (0,int(data.highPoint*1.5)))
 
+# This function returns the top line of the output file: the time
+# followed by the name and temperature of each named dataset.
+def header(data):
+    contents = "Time"
+    for i in range(data.channels):
+        if data.label[i] == "": continue
+        contents += "," + data.label[i] + ",Temp"
+    return contents
+
+# This function returns the metadata of the column file of the run: the
+# labels, MAC addresses, and calibration of the named datasets, the
+# spacing, and the baseline.
+def columnMeta(data):
+    named = [i for i in range(data.channels) if data.label[i] != ""]
+    sensors = [data.registry.sensors[i] for i in named]
+    return {"labels":[data.label[i] for i in named],
+        "macs":[sensor.mac for sensor in sensors],
+        "calibration":[list(sensor.calibration) for sensor in sensors],
+        "start":data.startTime*data.convert,"spacing":data.spacing,
+        "lb":data.lb,"ub":data.ub,
+        "baseline":[data.baseline[i] for i in named],
+        "basetemp":[data.basetemp[i] for i in named]}
+
 # This function saves the data generated since the last save into a text
 # file specified by the user. The data is saved with a top line of 
 # dataset names, followed by lines with time followed by pressure and 
 # temperature data for each dataset. Points per line are separated by commas.
+# Only the new lines are appended to the end of the file, and to the
+# column file as a chunk.
 def save(data):
-    # the file may not exist or be empty: if so, add first line
-    try: contents = readFile(data.fileName)
-    except: 
-        contents = "Time"
-        for i in range(len(data.midPoints)):
-            if data.label[i] == "": continue
-            contents += "," + data.label[i] + ",Temp"
-    if contents == "":
-        contents = "Time"
-        for i in range(len(data.midPoints)):
-            if data.label[i] == "": continue
-            contents += "," + data.label[i] + ",Temp"
-    # add all collected data to contents of file and write out
-    contents += data.newData
-    contents = contents.strip()
-    writeFile(data.fileName, contents)
+    data.writer.write(data.newData)
     data.newData = ""
-
-# This function uses linear interpolation using two points and a value 
-# which are strings of floats. It outputs the calculated value as a string.
-def interpolate(data,x1,x2,y1,y2,x):
-    if data.filler in (x1,x2,y1,y2,x): return data.filler
-    return str(round(float(y1)+(float(x)-
-        float(x1))*(float(y2)-float(y1))/(float(x2)-float(x1)),2))
+    if data.columns != None:
+        data.columns.updateMeta(**columnMeta(data))
+        data.columns.flush()
 
 # This function runs post-processing on the text file to replace all 
 # missing points within the run with linearly interpolated points.
 # After processing, the only non-values will be at the end of the file,
 # when no more data was received from said sensor before ending the run.
 def process(data):
-    # gathers current data in file and separates points into lists
-    contents = readFile(data.fileName)
-    lines = contents.split("\n")
-    points = []
-    for line in lines:
-        points.append(line.split(","))
-    # runs through columns of data
-    for j in range(1,len(points[0])):
-        # initial point is time of 0 and baseline
-        if j % 2 == 1: LB = 0,data.baseline[j/2]
-        else: LB = 0,data.basetemp[(j-1)/2]
-        UB = None
-        for i in range(1,len(points)):
-            # for points with no scanned data, the value is calculated
-            # via linear interpolation
-            if points[i][j] == data.filler: 
-                if UB == None: # finds upper bound point to interpolate with
-                    move = 1
-                    while (UB == None):
-                        if i + move >= len(points): # no upper point exists
-                            break
-                        elif points[i+move][j] != data.filler: 
-                            UB = points[i+move][0],points[i+move][j]
-                            points[i][j] = interpolate(data,LB[0],
-                                UB[0],LB[1],UB[1],points[i][0])
-                            break
-                        move += 1
-                else: 
-                    points[i][j] = interpolate(data,LB[0],UB[0],LB[1],UB[1],
-                        points[i][0])
-            else: # sets found point as new lower bound
-                LB = points[i][0],points[i][j]
-                UB = None
-    # formats calculated data back into file format
-    for i in range(len(points)):
-        points[i] = (",").join(points[i])
-    contents = ("\n").join(points)
-    writeFile(data.fileName,contents)
-
-# This function checks for time-sensitive operations every millisecond.
+    processFile(data.fileName,data.filler,data.baseline,data.basetemp)
+
+# This function does the time-sensitive operations whose deadlines have
+# passed. Points are added at whole multiples of the spacing from the
+# start of the run, and are timed as such, however late they are added.
 def timerFired(data):
+    now = data.schedule.clock()
+    data.profiler.poll()
+    if data.schedule.due("collect",now):
+        with data.profiler.span("runScan"): runScan(data)
     # during run, points are added to the graphs after user-stated time
-    if data.running: runScan(data)
-    if data.running and (time.time()/data.convert - data.lastTime 
-                                                        > data.spacing):
-        data.lastTime = time.time()/data.convert
-        averagePoints(data)
-        scaleGraphs(data)
+    if data.running and data.schedule.due("point",now):
+        with data.profiler.span("runScan"): runScan(data)
+        data.lastTime = data.startTime + (data.schedule["point"].last()
+            - data.runStart)/data.convert
+        with data.profiler.span("averagePoints"): averagePoints(data)
+        with data.profiler.span("scaleGraphs"): scaleGraphs(data)
+        data.dirty = True
     # every 5 minutes write output file (ensure minimal data loss) 
-    if data.running and (time.time()/data.convert - data.startTime > 5):
-        data.lastSave = time.time()/data.convert
-        save(data)
+    if data.running and data.schedule.due("save",now):
+        with data.profiler.span("save"):
+            data.telemetry.time("save",save,data)
+        data.telemetry.dump(data.metricsFile)
     # updates pipe symbol in text being edited to make edit visible
-    if data.editing != None and data.time % 5 == 0:
+    if data.schedule.due("blink",now) and data.editing != None:
         data.pipe = not data.pipe
         data.editing.updateText(data,piping(data,data.editing.text))
-    data.time += 1
-
-# This function writes the current pressures and temperatures onto the UI.
-def drawPressures(canvas,data):
+        data.dirty = True
+    # shown metrics are refreshed every second
+    if data.schedule.due("refresh",now) and data.showMetrics:
+        data.dirty = True
+
+# This function changes the text of a canvas item, if it has changed.
+def setText(canvas,data,item,text):
+    if data.shownText.get(item) != text:
+        canvas.itemconfig(item,text=text)
+        data.shownText[item] = text
+
+# This function creates the canvas items which are always shown: the
+# background, pressure and temperature readouts, error message, and
+# bound line.
+def createItems(canvas,data):
+    data.canvasItems = dict()
+    canvas.create_rectangle(-5,-5,data.width+5,data.height+5,fill="gray72")
     vTop = 2*data.margin
     vBot = data.height*3/4
-    bheight = (vBot-vTop-15*(data.margin/2))/16
+    bheight = (vBot-vTop-(data.channels-1)*(data.margin/2))/data.channels
     left = data.width-3*data.margin
     # has high and low-res font sizes
     font = "Arial 10 bold" if data.width == 1600 else "Arial 8 bold"
-    for i in range(16):
+    data.canvasItems["pressures"] = []
+    for i in range(data.channels):
         # writes data next to legend
         top = vTop+(data.margin/2+bheight)*i+bheight/2
+        data.canvasItems["pressures"].append(canvas.create_text(left,top,
+            anchor="w",font=font,fill="black"))
+    canvas.create_text(left,vTop-data.margin/2-bheight*0.5,text="P    T",
+        anchor="w",font=font)
+    # writes an error message if necessary
+    data.canvasItems["error"] = canvas.create_text(
+        data.width/2-0.5*data.margin,data.height*3/4-0.5*data.margin,
+        font = "Arial 12 bold",fill="red")
+    data.canvasItems["bound"] = canvas.create_line(0,0,0,0,
+        fill="light green",width="2",state="hidden")
+    # the metrics panel covers the normalized graph while shown, and the
+    # lifetimes panel covers the raw graph
+    createPanel(canvas,data,"metrics",(data.width/2-2*data.margin,
+        data.margin,data.width-7*data.margin,data.height*3/4-data.margin))
+    createPanel(canvas,data,"lifetimes",(2*data.margin,data.margin,
+        data.width/2-3*data.margin,data.height*3/4-data.margin))
+
+# This function creates the hidden box and text of a panel of text shown
+# over the graphs.
+def createPanel(canvas,data,name,coords):
+    left,top,right,bottom = coords
+    data.canvasItems[name + "Box"] = canvas.create_rectangle(coords,
+        fill="white",state="hidden")
+    data.canvasItems[name] = canvas.create_text(left+data.margin/2,
+        top+data.margin/2,anchor="nw",font="Courier 9",fill="black",
+        state="hidden")
+
+# This function writes the current pressures and temperatures onto the UI.
+def drawPressures(canvas,data):
+    for i in range(data.channels):
         if data.label[i] == "": text = ""
         elif data.pressures[i] == "": text = ""
         else: text = (str(data.pressures[i]) + ", " + str(data.temps[i]))
-        canvas.create_text(left,top,text=text,
-            anchor="w",font=font,fill="black")
-    canvas.create_text(left,vTop-data.margin/2-bheight*0.5,text="P    T",
-        anchor="w",font=font)
+        setText(canvas,data,data.canvasItems["pressures"][i],text)
 
 # This function draws the boundary lines on the graph.
 def drawBoundLines(data, canvas):
+    line = data.canvasItems["bound"]
     if data.bound != None:
-        canvas.create_line(data.bound,data.rawGraph.axisLimits[1],
-            data.bound,data.rawGraph.axisLimits[3],fill="light green",width="2")
-
-# This function redraws the UI every millisecond
+        canvas.coords(line,data.bound,data.rawGraph.axisLimits[1],
+            data.bound,data.rawGraph.axisLimits[3])
+        canvas.itemconfig(line,state="normal")
+        canvas.tag_raise(line)
+    else: canvas.itemconfig(line,state="hidden")
+
+# This function shows the given lines of text in a panel, or hides the
+# panel if lines is None.
+def drawPanel(canvas,data,name,lines):
+    box,text = data.canvasItems[name + "Box"],data.canvasItems[name]
+    if lines != None:
+        setText(canvas,data,text,"\n".join(lines))
+        for item in (box,text):
+            canvas.itemconfig(item,state="normal")
+            canvas.tag_raise(item)
+    else:
+        for item in (box,text): canvas.itemconfig(item,state="hidden")
+
+# This function returns the lifetime of each named dataset as lines of
+# text.
+def lifetimeLines(data):
+    lines = ["%-10s %12s %7s" % ("dataset","lifetime min","points")]
+    for i in range(data.channels):
+        if data.label[i] == "": continue
+        lifetime = data.fits[i].lifetime()
+        lines.append("%-10s %12s %7d" % (data.label[i][:10],
+            "-" if lifetime == None else "%.1f" % lifetime,
+            data.fits[i].count))
+    return lines
+
+# This function shows the acquisition metrics over the normalized graph
+# and the lifetimes over the raw graph, or hides them.
+def drawPanels(canvas,data):
+    drawPanel(canvas,data,"metrics",data.telemetry.lines() +
+        data.profiler.lines() if data.showMetrics else None)
+    drawPanel(canvas,data,"lifetimes",
+        lifetimeLines(data) if data.showLifetimes else None)
+
+# This function redraws the parts of the UI that have changed.
 def redrawAll(canvas, data):
-    canvas.create_rectangle(-5,-5,data.width+5,data.height+5,fill="gray72")
-    data.rawGraph.drawGraph(canvas,data)
-    data.normGraph.drawGraph(canvas,data)
+    if data.canvasItems == None: createItems(canvas,data)
+    # removes graphs replaced at the start of a run
+    for graph in data.shownGraphs:
+        if graph not in (data.rawGraph,data.normGraph): 
+            canvas.delete(graph.tag)
+    data.shownGraphs = [data.rawGraph,data.normGraph]
+    with data.profiler.span("drawGraph raw"):
+        data.rawGraph.drawGraph(canvas,data)
+    with data.profiler.span("drawGraph normalized"):
+        data.normGraph.drawGraph(canvas,data)
     for icon in data.icons:
         icon.drawIcon(canvas)
     drawPressures(canvas,data)
-    # writes an error message if necessary
-    canvas.create_text(data.width/2-0.5*data.margin,
-        data.height*3/4-0.5*data.margin,text=data.error,font = "Arial 12 bold",
-        fill="red")
+    setText(canvas,data,data.canvasItems["error"],data.error)
     drawBoundLines(data,canvas)
+    drawPanels(canvas,data)
 
 ####################################
 # use the run function as-is
@@ -922,29 +1094,37 @@ def redrawAll(canvas, data):
 
 def run(width=300, height=300):
     def redrawAllWrapper(canvas, data):
-        canvas.delete(ALL)
-        redrawAll(canvas, data)
+        # canvas items are kept, and only redrawn after a change
+        if not data.dirty: return
+        with data.profiler.span("redrawAll"):
+            data.telemetry.time("redrawAll",redrawAll,canvas,data)
+        data.dirty = False
         canvas.update()    
 
     def mousePressedWrapper(event, canvas, data):
-        mousePressed(event, data)
-        redrawAllWrapper(canvas, data)
+        with data.profiler.work():
+            mousePressed(event, data)
+            data.dirty = True
+            redrawAllWrapper(canvas, data)
 
     def keyPressedWrapper(event, canvas, data):
-        keyPressed(event, data)
-        redrawAllWrapper(canvas, data)
+        with data.profiler.work():
+            keyPressed(event, data)
+            data.dirty = True
+            redrawAllWrapper(canvas, data)
 
     def timerFiredWrapper(canvas, data):
-        timerFired(data)
-        redrawAllWrapper(canvas, data)
-        # pause, then call timerFired again
-        canvas.after(data.timerDelay, timerFiredWrapper, canvas, data)
+        with data.profiler.work():
+            timerFired(data)
+            redrawAllWrapper(canvas, data)
+        # pause until the next deadline, then call timerFired again
+        delay = int(math.ceil(1000*data.schedule.wait()))
+        canvas.after(max(1,delay), timerFiredWrapper, canvas, data)
     # Set up data and call init
     class Struct(object): pass
     data = Struct()
     data.width = width
     data.height = height
-    data.timerDelay = 100 # milliseconds
     init(data)
     # create the root and the canvas
     root = Tk()
@@ -958,7 +1138,10 @@ def run(width=300, height=300):
     timerFiredWrapper(canvas, data)
     # and launch the app
     root.mainloop()  # blocks until window is closed
+    data.scanThread.stop()
+    data.profiler.close()
     # print("bye!")
     print(data.color)
 
-run(1600, 800) # (1200,600) for low_res
\ No newline at end of file
+if __name__ == "__main__":
+    run(1600, 800) # (1200,600) for low_res
\ No newline at end of file
@@ -0,0 +1,451 @@
+
+# collect.py
+
+# This file gathers the samples of several acquisition nodes, such as one
+# bscan.py per rig, into one store, so that a whole bench of sensors can
+# be looked at and exported in one place instead of from one text file per
+# rig. Nodes connect over TCP or a Unix socket and send their samples in
+# batches, in a compact binary format. Sensors are told apart by MAC
+# address, so the same sensor heard by two nodes is stored on one channel.
+
+# The wire format is a series of frames, each a one byte kind and a four
+# byte length followed by that many bytes. A node first sends a HELLO
+# frame, a JSON object of its name and the MAC address and label of each
+# of its channels, then BATCH frames of fixed size samples of time
+# (seconds since the epoch), channel, pressure, and temperature. The
+# nodes' clocks are assumed to be set, such as by NTP.
+
+# To run the collector:
+#   > python collect.py [-l localhost:7070] [--log bench.bin] [-o bench.txt]
+#   - the address is a host:port to listen on, or the path of a Unix
+#       socket
+#   - every sample is appended to the --log sample log as it arrives
+#   - a summary of the nodes and sensors is printed every --every seconds
+#   - on Ctrl-C, the log is written to the -o run file, with a row every
+#       --spacing minutes
+# To write the run file of a log, such as after a crash:
+#   > python collect.py --export --log bench.bin -o bench.txt
+# To send samples from a rig, or from a stand in on the same machine:
+#   > sudo python bscan.py --send localhost:7070
+#   > python bscan.py --simulate --send localhost:7070 -o /dev/null
+
+
+import argparse
+from collections import deque
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+try: import socketserver
+except ImportError: import SocketServer as socketserver
+
+# numpy is optional, and only used to find the start of a log quickly
+try: import numpy
+except ImportError: numpy = None
+
+from rawlog import LogWriter, LogReader, exportCsv
+from tpms import Sensor, SensorRegistry
+
+# frame header: kind and payload length
+FRAME = struct.Struct("<BI")
+HELLO,BATCH = 1,2
+# time (seconds since the epoch), channel on the node, pressure, and
+# temperature
+SAMPLE = struct.Struct("<dHff")
+# the largest payload accepted, against a corrupt length
+MAX_PAYLOAD = 1 << 24
+
+# This function returns the socket family and address of an address
+# given as host:port, or as the path of a Unix socket.
+def parseAddress(address):
+    if ":" in address:
+        host,port = address.rsplit(":",1)
+        return socket.AF_INET,(host,int(port))
+    return socket.AF_UNIX,address
+
+# This function packs a frame of the given kind.
+def frame(kind,payload):
+    return FRAME.pack(kind,len(payload)) + payload
+
+# This function returns the HELLO frame of a node with the given name and
+# registry.
+def helloFrame(name,registry):
+    sensors = [[sensor.mac,sensor.label] for sensor in registry.sensors]
+    return frame(HELLO,json.dumps({"node":name,"sensors":sensors})
+        .encode("utf-8"))
+
+# This function returns the BATCH frame of a list of (time,channel,
+# pressure,temp) samples.
+def batchFrame(samples):
+    return frame(BATCH,b"".join(SAMPLE.pack(t,channel,pressure,temp)
+        for (t,channel,pressure,temp) in samples))
+
+# This function reads exactly size bytes from a socket, or returns None if
+# the connection closes first.
+def readExactly(sock,size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size,65536))
+        if not chunk: return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+# This function reads the next frame from a socket as (kind,payload), or
+# returns None if the connection closes. ValueError is raised if the frame
+# is too long to be a frame of this format.
+def readFrame(sock):
+    header = readExactly(sock,FRAME.size)
+    if header == None: return None
+    kind,size = FRAME.unpack(header)
+    if size > MAX_PAYLOAD: raise ValueError("frame too long: %d" % size)
+    payload = readExactly(sock,size)
+    if payload == None: return None
+    return kind,payload
+
+# This class sends the samples of one node to a collector from a thread
+# of its own, so that the scan only queues them and never waits on the
+# network. While the collector cannot be reached, connecting is tried
+# again after a delay that doubles up to limit seconds, and batches wait
+# in the queue; once it holds queued samples, the oldest batches are
+# dropped. A batch that fails to send is dropped.
+class Sender(threading.Thread):
+
+    def __init__(self,address,registry,name=None,queued=100000,base=1.0,
+        limit=60.0):
+        threading.Thread.__init__(self)
+        self.daemon = True # does not keep the program open on exit
+        self.address = address
+        self.hello = helloFrame(name if name != None
+            else socket.gethostname(),registry)
+        self.sock = None
+        self.sent = self.dropped = 0 # samples
+        self.queued = queued # samples waiting at most
+        self.base = base # seconds before the first retry
+        self.limit = limit # seconds between retries at most
+        self.batches = deque() # batches waiting to be sent
+        self.waiting = 0 # samples in batches
+        self.ready = threading.Condition()
+        self.sending = True
+        self.start()
+
+    # This function connects and introduces the node.
+    def connect(self):
+        family,address = parseAddress(self.address)
+        self.sock = socket.socket(family,socket.SOCK_STREAM)
+        self.sock.settimeout(5.0)
+        self.sock.connect(address)
+        self.sock.sendall(self.hello)
+
+    # This function queues a list of (time,channel,pressure,temp) samples
+    # to be sent, without waiting.
+    def send(self,samples):
+        if samples == []: return
+        with self.ready:
+            self.batches.append(samples)
+            self.waiting += len(samples)
+            while self.waiting > self.queued and len(self.batches) > 1:
+                dropped = self.batches.popleft()
+                self.waiting -= len(dropped)
+                self.dropped += len(dropped)
+            self.ready.notify()
+
+    # This function sends queued batches until the sender is closed, and
+    # then whatever is left if the collector can be reached.
+    def run(self):
+        delay = 0.0 # seconds to wait before connecting again
+        while True:
+            with self.ready:
+                while self.sending and len(self.batches) == 0:
+                    self.ready.wait()
+                if not self.sending and len(self.batches) == 0: break
+            try:
+                if self.sock == None:
+                    # the first try after a failure waits, unless closing
+                    if delay > 0 and self.sending:
+                        with self.ready: self.ready.wait(delay)
+                    self.connect()
+                    delay = 0.0
+                with self.ready:
+                    if len(self.batches) == 0: continue
+                    samples = self.batches.popleft()
+                    self.waiting -= len(samples)
+                try:
+                    self.sock.sendall(batchFrame(samples))
+                    self.sent += len(samples)
+                except (socket.error,OSError):
+                    self.dropped += len(samples)
+                    raise
+            except (socket.error,OSError):
+                self.disconnect()
+                if not self.sending:
+                    # the collector is gone, and what is left is dropped
+                    with self.ready:
+                        self.dropped += self.waiting
+                        self.batches.clear()
+                        self.waiting = 0
+                    break
+                delay = min(self.limit,max(self.base,2*delay))
+        self.disconnect()
+
+    # This function closes the connection.
+    def disconnect(self):
+        if self.sock == None: return
+        try: self.sock.close()
+        except (socket.error,OSError): pass
+        self.sock = None
+
+    # This function sends what is queued, waiting up to timeout seconds,
+    # and stops the sender.
+    def close(self,timeout=5.0):
+        with self.ready:
+            self.sending = False
+            self.ready.notify()
+        self.join(timeout)
+
+# This class merges the samples of all nodes. Each sensor is given a
+# channel of its own the first time a node lists it, and every sample is
+# appended as it arrives to a sample log, as written by bscan.py, on the
+# collector's channel, so nothing is held in memory and a crash loses at
+# most the batch being written. The channels are kept in a JSON file
+# beside the log, so a collector started again on the same log carries on
+# with them. The same sample of a sensor sent twice, at exactly the same
+# time, is stored once; samples that arrive out of order are kept, and
+# are put in order when the run file is written.
+class Collector(object):
+
+    def __init__(self,logPath,sync=False,recent=1024):
+        self.lock = threading.Lock()
+        self.logPath = logPath
+        self.macs = [] # MAC address of each channel
+        self.labels = [] # label of each channel
+        self.index = dict() # MAC address -> channel
+        if os.path.isfile(channelsPath(logPath)):
+            with open(channelsPath(logPath), "rt") as f:
+                for mac,label in json.load(f)["sensors"]:
+                    self.index[mac] = len(self.macs)
+                    self.macs.append(mac)
+                    self.labels.append(label)
+        self.log = LogWriter(logPath,sync)
+        self.recent = recent # times kept per channel to find duplicates
+        self.seen = dict() # channel -> (set,deque) of its latest times
+        self.nodes = dict() # name -> counts and state of the node
+        self.dropped = 0 # samples dropped as duplicates
+
+    def __len__(self):
+        return len(self.macs)
+
+    # This function replaces the file of the channels of the log.
+    def saveChannels(self):
+        path = channelsPath(self.logPath)
+        with open(path + ".tmp", "wt") as f:
+            json.dump({"sensors":[[mac,label] for mac,label in
+                zip(self.macs,self.labels)]},f,indent=1)
+        os.rename(path + ".tmp",path)
+
+    # This function registers a node from the contents of its HELLO frame,
+    # and returns the channel of the collector of each of its channels.
+    def hello(self,payload):
+        info = json.loads(payload.decode("utf-8"))
+        with self.lock:
+            channels = []
+            changed = False
+            for mac,label in info["sensors"]:
+                mac = mac.lower()
+                if mac not in self.index:
+                    self.index[mac] = len(self.macs)
+                    self.macs.append(mac)
+                    self.labels.append(label)
+                    changed = True
+                elif label != "" and self.labels[self.index[mac]] == "":
+                    self.labels[self.index[mac]] = label
+                    changed = True
+                channels.append(self.index[mac])
+            if changed: self.saveChannels()
+            node = self.nodes.setdefault(info["node"],
+                {"samples":0,"connections":0})
+            node["connections"] += 1
+            node["connected"] = True
+            node["channels"] = len(channels)
+        return info["node"],channels
+
+    # This function determines if a sample of a channel at time t was
+    # already stored, among the latest times of the channel, and
+    # remembers t otherwise.
+    def isDuplicate(self,entry,t):
+        times,order = self.seen.setdefault(entry,(set(),deque()))
+        if t in times: return True
+        times.add(t)
+        order.append(t)
+        if len(order) > self.recent: times.discard(order.popleft())
+        return False
+
+    # This function adds the samples of a BATCH frame from a node, whose
+    # channels are mapped to those of the collector by channels, and
+    # pushes them to the log.
+    def add(self,name,channels,payload):
+        count = len(payload) // SAMPLE.size
+        stored = 0
+        with self.lock:
+            for i in range(count):
+                t,channel,pressure,temp = SAMPLE.unpack_from(payload,
+                    i * SAMPLE.size)
+                if channel >= len(channels): continue
+                entry = channels[channel]
+                if self.isDuplicate(entry,t):
+                    self.dropped += 1
+                    continue
+                # the raw counts are not sent
+                self.log.write(t,entry,pressure,temp,(0,0))
+                stored += 1
+            self.log.flush()
+            node = self.nodes[name]
+            node["samples"] += stored
+            node["last"] = time.time()
+
+    # This function marks a node as disconnected.
+    def bye(self,name):
+        with self.lock:
+            self.nodes[name]["connected"] = False
+
+    # This function returns a summary of the nodes and sensors as lines of
+    # text.
+    def lines(self):
+        with self.lock:
+            lines = []
+            for name in sorted(self.nodes):
+                node = self.nodes[name]
+                lines.append("%-16s %s, %d channels, %d samples" % (name[:16],
+                    "connected" if node["connected"] else "gone",
+                    node["channels"],node["samples"]))
+            lines.append("%d sensors, %d duplicate samples dropped" % (
+                len(self.macs),self.dropped))
+            return lines
+
+    # This function writes the log as the text file of a run, as in
+    # writeRun.
+    def writeRun(self,path,spacing=3,filler="None"):
+        with self.lock: self.log.flush()
+        writeRun(self.logPath,path,spacing,filler)
+
+    # This function closes the log.
+    def close(self):
+        with self.lock: self.log.close()
+
+# This function returns the path of the file of the channels of a log.
+def channelsPath(logPath):
+    return logPath + ".json"
+
+# This function writes the log of a collector as the text file of a run,
+# in the same layout as btpressure.py: one row of averages every spacing
+# minutes from the earliest sample, with the filler where a channel has no
+# samples. Channels without a label are named by their MAC address. The
+# log is read a sample at a time, so it can be written while the
+# collector runs, or after it has stopped.
+def writeRun(logPath,path,spacing=3,filler="None"):
+    with open(channelsPath(logPath), "rt") as f:
+        sensors = json.load(f)["sensors"]
+    registry = SensorRegistry([Sensor(i,mac,label if label != "" else mac)
+        for i,(mac,label) in enumerate(sensors)])
+    with LogReader(logPath) as log:
+        if len(log) == 0: start = None
+        elif numpy != None: start = float(log.column("time").min())
+        else: start = min(record[0] for record in log)
+    exportCsv(logPath,registry,path,spacing,start,filler)
+
+# This class handles the connection of one node: a HELLO frame, then any
+# number of BATCH frames until the node disconnects.
+class NodeHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        collector = self.server.collector
+        name,channels = None,[]
+        try:
+            while True:
+                found = readFrame(self.request)
+                if found == None: break
+                kind,payload = found
+                if kind == HELLO: name,channels = collector.hello(payload)
+                elif kind == BATCH and name != None:
+                    collector.add(name,channels,payload)
+        except (socket.error,OSError,ValueError):
+            pass
+        if name != None: collector.bye(name)
+
+class TCPServer(socketserver.ThreadingMixIn,socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(socketserver,"UnixStreamServer"):
+    class UnixServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+        daemon_threads = True
+else: UnixServer = None
+
+# This function returns a server for the collector listening at the given
+# address, which is served from a thread by serve_forever.
+def makeServer(collector,address):
+    family,address = parseAddress(address)
+    if family == socket.AF_UNIX:
+        if UnixServer == None: raise ValueError("no Unix sockets here")
+        if os.path.exists(address): os.remove(address)
+        server = UnixServer(address,NodeHandler)
+    else: server = TCPServer(address,NodeHandler)
+    server.collector = collector
+    return server
+
+# This function reads the command line options.
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description="Collect the samples of several acquisition nodes.")
+    parser.add_argument("-l","--listen",default="localhost:7070",
+        help="host:port or Unix socket path to listen on "
+            "(default localhost:7070)")
+    parser.add_argument("--log",default="bench.bin",
+        help="sample log to append the samples to (default bench.bin)")
+    parser.add_argument("--sync",action="store_true",
+        help="wait for the disk after every batch")
+    parser.add_argument("-o","--out",
+        help="run file to write the merged samples to when stopped")
+    parser.add_argument("--spacing",type=float,default=3,
+        help="minutes between rows of the run file (default 3)")
+    parser.add_argument("--every",type=float,default=10,
+        help="seconds between summaries (default 10)")
+    parser.add_argument("--export",action="store_true",
+        help="only write the run file of the log, without collecting")
+    return parser.parse_args(argv)
+
+# This function is run when the process is asked to stop, and stops the
+# collector the same way as Ctrl-C.
+def interrupt(signum,frame):
+    raise KeyboardInterrupt()
+
+def main(argv=None):
+    args = parseArgs(sys.argv[1:] if argv == None else argv)
+    if args.export:
+        writeRun(args.log,args.out or "run.txt",args.spacing)
+        return
+    collector = Collector(args.log,args.sync)
+    server = makeServer(collector,args.listen)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    signal.signal(signal.SIGTERM,interrupt)
+    try:
+        while True:
+            time.sleep(args.every)
+            print("\n".join(collector.lines()))
+    except KeyboardInterrupt:
+        server.shutdown()
+        server.server_close()
+        if args.out != None: collector.writeRun(args.out,args.spacing)
+        collector.close()
+        print("collected")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+
+# columns.py
+
+# This file writes the points of a run as typed columns, next to the text
+# file of btpressure.py, so that they can be loaded for analysis without
+# parsing. The column file holds a time column of doubles, in minutes
+# from the start of the run, and a pressure and a temperature column of
+# floats for each recorded dataset, with NaN where a point is missing.
+# Rows are appended in chunks at every save, each chunk storing its
+# columns one after another. The labels, MAC addresses, and calibration
+# of the datasets, the spacing, and the baseline are kept in a JSON file
+# beside it, which is replaced whenever they change.
+
+# With numpy installed, each chunk is read as arrays viewing a memory map
+# of the file, and a run can be loaded into pandas, or exported to NPZ,
+# or to Parquet or HDF5 where pandas has the libraries for them.
+
+# To export a column file:
+#   > python columns.py run.cols -o run.npz (or run.parquet, run.h5)
+
+
+import argparse
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+# numpy is optional, and only needed to read the columns as arrays
+try: import numpy
+except ImportError: numpy = None
+
+# start of every column file, followed by the number of datasets
+MAGIC = b"TPMSCOL1"
+HEADER = struct.Struct("<8sI4x")
+# start of every chunk, followed by its number of rows
+CHUNK = struct.Struct("<4sI8x")
+CHUNK_MAGIC = b"ROWS"
+
+# This function returns the path of the metadata file of a column file.
+def metaPath(path):
+    return path + ".json"
+
+# This function reads the header of a column file, and returns the number
+# of datasets. ValueError is raised if the file is not a column file.
+def checkHeader(f):
+    f.seek(0)
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size: raise ValueError("no column file header")
+    magic,datasets = HEADER.unpack(header)
+    if magic != MAGIC: raise ValueError("not a column file: " + f.name)
+    return datasets
+
+# This function returns the size in bytes of a chunk of the given number
+# of rows and datasets.
+def chunkSize(rows,datasets):
+    return CHUNK.size + 8*rows + 2*4*rows*datasets
+
+# This function returns the bytes of an array, in little endian order.
+def packed(column):
+    if sys.byteorder != "little": column.byteswap()
+    if hasattr(column,"tobytes"): return column.tobytes()
+    return column.tostring()
+
+# This class appends rows to the column file of a run. Each row is a time
+# and a list of (pressure,temp) points, one per dataset, with None for a
+# missing point. Rows are held until flush, which writes them as a chunk.
+class ColumnWriter(object):
+
+    def __init__(self,path,meta):
+        self.path = path
+        self.datasets = len(meta["labels"])
+        self.rows = [] # rows since the last flush
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        if size > 0:
+            with open(path, "r+b") as f:
+                if checkHeader(f) != self.datasets:
+                    raise ValueError("datasets differ from " + path)
+                # drops a chunk cut short by a crash
+                f.truncate(lastChunkEnd(f,self.datasets))
+        self.file = open(path, "ab")
+        if size == 0:
+            self.file.write(HEADER.pack(MAGIC,self.datasets))
+            self.file.flush()
+        self.setMeta(meta)
+
+    # This function replaces the metadata of the run.
+    def setMeta(self,meta):
+        self.meta = dict(meta)
+        temp = metaPath(self.path) + ".tmp"
+        with open(temp, "wt") as f:
+            json.dump(self.meta,f,indent=1,sort_keys=True)
+        os.rename(temp,metaPath(self.path))
+
+    # This function updates some of the metadata of the run.
+    def updateMeta(self,**changes):
+        meta = dict(self.meta)
+        meta.update(changes)
+        if meta != self.meta: self.setMeta(meta)
+
+    # This function adds a row.
+    def add(self,t,points):
+        self.rows.append((t,points))
+
+    # This function writes the rows added since the last flush as a chunk.
+    def flush(self):
+        if self.rows == []: return
+        nan = float("nan")
+        rows = len(self.rows)
+        self.file.write(CHUNK.pack(CHUNK_MAGIC,rows))
+        self.file.write(packed(array.array("d",
+            [t for (t,points) in self.rows])))
+        for i in range(self.datasets):
+            for k in range(2):
+                self.file.write(packed(array.array("f",[nan if points[i]
+                    == None else points[i][k] for (t,points) in self.rows])))
+        self.file.flush()
+        self.rows = []
+
+    # This function flushes and closes the file.
+    def close(self):
+        if self.file.closed: return
+        self.flush()
+        self.file.close()
+
+# This function returns the end of the last whole chunk of a column file,
+# reading only the chunk headers.
+def lastChunkEnd(f,datasets):
+    size = os.fstat(f.fileno()).st_size
+    end = HEADER.size
+    while end + CHUNK.size <= size:
+        f.seek(end)
+        magic,rows = CHUNK.unpack(f.read(CHUNK.size))
+        if magic != CHUNK_MAGIC: break
+        if end + chunkSize(rows,datasets) > size: break
+        end += chunkSize(rows,datasets)
+    return end
+
+# This class reads a column file through a memory map, with its metadata.
+# Only the chunks present when the file is opened are seen. Columns are
+# returned as numpy arrays, which view the map when the file has a single
+# chunk, so they must be let go of before the file is closed.
+class ColumnReader(object):
+
+    def __init__(self,path):
+        if numpy == None: raise ImportError("ColumnReader requires numpy")
+        self.path = path
+        self.file = open(path, "rb")
+        self.datasets = checkHeader(self.file)
+        with open(metaPath(path), "rt") as f:
+            self.meta = json.load(f)
+        end = lastChunkEnd(self.file,self.datasets)
+        self.map = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        # offset and number of rows of each chunk
+        self.chunks = []
+        offset = HEADER.size
+        while offset < end:
+            magic,rows = CHUNK.unpack_from(self.map,offset)
+            self.chunks.append((offset + CHUNK.size,rows))
+            offset += chunkSize(rows,self.datasets)
+
+    def __len__(self):
+        return sum(rows for (offset,rows) in self.chunks)
+
+    # This function returns column k of every chunk, where column 0 is the
+    # time and columns 2i+1 and 2i+2 are the pressure and temperature of
+    # dataset i.
+    def column(self,k):
+        parts = []
+        for (offset,rows) in self.chunks:
+            if k == 0: parts.append(numpy.frombuffer(self.map,dtype="<f8",
+                count=rows,offset=offset))
+            else: parts.append(numpy.frombuffer(self.map,dtype="<f4",
+                count=rows,offset=offset + 8*rows + 4*rows*(k-1)))
+        if parts == []: return numpy.zeros(0,dtype="<f8" if k == 0
+            else "<f4")
+        if len(parts) == 1: return parts[0]
+        return numpy.concatenate(parts)
+
+    # This function returns the time column, in minutes.
+    def times(self):
+        return self.column(0)
+
+    # This function returns the pressure column of dataset i.
+    def pressures(self,i):
+        return self.column(2*i + 1)
+
+    # This function returns the temperature column of dataset i.
+    def temps(self,i):
+        return self.column(2*i + 2)
+
+    # This function returns all columns, as a dictionary of name -> array,
+    # with the columns of each dataset named by its label.
+    def columns(self):
+        columns = {"time":self.times()}
+        for i,label in enumerate(self.meta["labels"]):
+            columns[label] = self.pressures(i)
+            columns[label + " temp"] = self.temps(i)
+        return columns
+
+    # This function returns all columns as a pandas DataFrame, indexed by
+    # time, with the metadata in its attrs.
+    def frame(self):
+        import pandas
+        columns = self.columns()
+        times = columns.pop("time")
+        frame = pandas.DataFrame(columns,index=pandas.Index(times,
+            name="time"))
+        frame.attrs.update(self.meta)
+        return frame
+
+    # This function closes the map and the file.
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+# This function writes a column file to out, in the format given by its
+# extension: .npz, or .parquet or .h5 through pandas.
+def export(path,out):
+    with ColumnReader(path) as reader:
+        if out.endswith(".npz"):
+            columns = dict((name,numpy.array(column)) for name,column in
+                reader.columns().items())
+            columns["meta"] = numpy.array(json.dumps(reader.meta))
+            numpy.savez(out,**columns)
+        elif out.endswith(".parquet"): reader.frame().to_parquet(out)
+        elif out.endswith(".h5"): reader.frame().to_hdf(out,key="run")
+        else: raise ValueError("unknown export format: " + out)
+
+# This function reads the command line options.
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description="Export the column file of a run.")
+    parser.add_argument("columns",help="column file written by btpressure.py")
+    parser.add_argument("-o","--out",default="run.npz",
+        help="file to write: .npz, .parquet, or .h5 (default run.npz)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(sys.argv[1:] if argv == None else argv)
+    export(args.columns,args.out)
+
+if __name__ == "__main__":
+    main()
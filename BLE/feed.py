@@ -0,0 +1,233 @@
+
+# feed.py
+
+# This file publishes the latest samples of every channel in shared
+# memory, so that other processes, such as analysis or alarm scripts, can
+# read them live without reading the sample or run files. The feed is a
+# file in /dev/shm, which is kept in memory and never written to disk,
+# mapped into both the writer and the readers.
+
+# Each channel has a ring of its latest samples, with a count of samples
+# written and a sequence number, which is odd while a sample is being
+# written. A reader copies what it needs between two reads of the
+# sequence number, and tries again if they differ, so it never sees a
+# half written sample and never holds up the writer. A new generation
+# number is written each time the feed is created, so readers can tell
+# that the writer started over.
+
+# To publish the samples of a scan:
+#   > sudo python bscan.py --feed
+# To read them, in another process:
+#   feed = FeedReader()
+#   t,pressure,temp = feed.latest(0)
+#   window = feed.window(0) # the latest samples of channel 0, in order
+# A read raises FeedStalled if the writer stopped in the middle of writing
+# the channel, such as when it was killed.
+
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+# numpy is optional, and only needed for array views of the feed
+try: import numpy
+except ImportError: numpy = None
+
+# the feed used when no path is given
+if os.path.isdir("/dev/shm"): FEED_FILE = "/dev/shm/tpms-feed"
+else: FEED_FILE = os.path.join(tempfile.gettempdir(),"tpms-feed")
+
+# start of every feed, followed by the number of channels, the samples
+# kept per channel, and the generation
+MAGIC = b"TPMSFEED"
+HEADER = struct.Struct("<8sIIQ8x")
+# MAC address of each channel
+MAC = struct.Struct("<18s6x")
+# sequence number and samples written of a channel
+COUNTS = struct.Struct("<QQ")
+# time (seconds since the epoch), pressure, and temperature
+SAMPLE = struct.Struct("<dff")
+
+# the layout of a sample, as a numpy type
+if numpy != None:
+    DTYPE = numpy.dtype([("time","<f8"),("pressure","<f4"),("temp","<f4")])
+else: DTYPE = None
+
+# This class is the error raised when a channel stays in the middle of a
+# write for longer than a reader waits, such as when the writer was
+# killed while writing it.
+class FeedStalled(IOError):
+    pass
+
+# This function returns the offset of the block of a channel: its counts
+# followed by its ring of samples.
+def blockOffset(channels,slots,channel):
+    return (HEADER.size + channels*MAC.size +
+        channel*(COUNTS.size + slots*SAMPLE.size))
+
+# This function returns the size of a feed.
+def feedSize(channels,slots):
+    return blockOffset(channels,slots,channels)
+
+# This class writes the samples of a scan to a new feed. Samples are
+# written by the scan threads of all adapters, so writes are locked. It
+# is used in the same way as rawlog.LogWriter.
+class FeedWriter(object):
+
+    def __init__(self,registry,path=FEED_FILE,slots=1024):
+        self.path = path
+        self.channels = len(registry)
+        self.slots = slots # samples kept per channel
+        self.lock = threading.Lock()
+        self.seq = [0] * self.channels
+        self.count = [0] * self.channels
+        # the feed is made whole under another name, then moved in place,
+        # so readers never map a partial feed
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            f.truncate(feedSize(self.channels,slots))
+        self.file = open(temp, "r+b")
+        self.map = mmap.mmap(self.file.fileno(),0)
+        generation = int(time.time()*1000)
+        HEADER.pack_into(self.map,0,MAGIC,self.channels,slots,generation)
+        for sensor in registry.sensors:
+            MAC.pack_into(self.map,HEADER.size + sensor.channel*MAC.size,
+                sensor.mac.encode("ascii"))
+        os.rename(temp,path)
+
+    # This function publishes one sample. The raw counts are not kept.
+    def write(self,t,channel,pressure,temp,raw=None):
+        offset = blockOffset(self.channels,self.slots,channel)
+        with self.lock:
+            seq,count = self.seq[channel],self.count[channel]
+            COUNTS.pack_into(self.map,offset,seq+1,count)
+            SAMPLE.pack_into(self.map,offset + COUNTS.size +
+                (count % self.slots)*SAMPLE.size,t,pressure,temp)
+            COUNTS.pack_into(self.map,offset,seq+2,count+1)
+            self.seq[channel],self.count[channel] = seq+2,count+1
+
+    # Samples are in the feed as soon as they are written; this function
+    # matches LogWriter.
+    def flush(self): pass
+
+    # This function closes the feed, and removes it so that readers do
+    # not take it for a live one.
+    def close(self):
+        if self.file.closed: return
+        self.map.close()
+        self.file.close()
+        if os.path.exists(self.path): os.remove(self.path)
+
+# This function reads the sample at an offset of the feed as a tuple.
+def unpackSample(buf,offset):
+    t,pressure,temp = SAMPLE.unpack_from(buf,offset)
+    # the values were rounded to a tenth before being stored as floats
+    return t,round(pressure,1),round(temp,1)
+
+# This class reads a feed. Samples are returned as (time,pressure,temp)
+# tuples, or as numpy arrays of DTYPE when numpy is installed.
+class FeedReader(object):
+
+    def __init__(self,path=FEED_FILE,timeout=0.1):
+        self.path = path
+        self.timeout = timeout # seconds to wait for a write to finish
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        magic,self.channels,self.slots,self.generation = HEADER.unpack_from(
+            self.map,0)
+        if magic != MAGIC: raise ValueError("not a feed: " + path)
+
+    def __len__(self):
+        return self.channels
+
+    # This function returns the MAC address of each channel.
+    def macs(self):
+        return [MAC.unpack_from(self.map,HEADER.size + i*MAC.size)[0]
+            .rstrip(b"\0").decode("ascii") for i in range(self.channels)]
+
+    # This function determines if the writer has since made a new feed,
+    # which must be opened again to be read.
+    def isStale(self):
+        try:
+            with open(self.path, "rb") as f:
+                header = f.read(HEADER.size)
+        except (IOError,OSError): return True
+        if len(header) < HEADER.size: return True
+        return HEADER.unpack(header)[3] != self.generation
+
+    # This function returns the sequence number and samples written of a
+    # channel. The sequence number is odd while a sample is being written.
+    def counts(self,channel):
+        return COUNTS.unpack_from(self.map,
+            blockOffset(self.channels,self.slots,channel))
+
+    # This function calls read with the number of samples written to a
+    # channel until no sample is written to it during the call, and
+    # returns what read returned. Other threads are let run between tries.
+    # FeedStalled is raised if that does not happen within the timeout.
+    def consistent(self,channel,read):
+        end = time.time() + self.timeout
+        while True:
+            seq,count = self.counts(channel)
+            if seq % 2 == 0:
+                result = read(count)
+                if self.counts(channel)[0] == seq: return result
+            if time.time() > end:
+                raise FeedStalled("channel %d of %s is still being written"
+                    % (channel,self.path))
+            time.sleep(0)
+
+    # This function returns the latest sample of a channel, or None if
+    # there is none.
+    def latest(self,channel):
+        offset = (blockOffset(self.channels,self.slots,channel) +
+            COUNTS.size)
+        def read(count):
+            if count == 0: return None
+            return unpackSample(self.map,
+                offset + ((count-1) % self.slots)*SAMPLE.size)
+        return self.consistent(channel,read)
+
+    # This function returns the ring of a channel as a numpy array viewing
+    # the feed, without copying it, along with the sequence number and the
+    # samples written. The sample written last is at (count-1) % slots. The
+    # view is only known to be whole if the channel's sequence number is
+    # still the same, and even, once it has been used.
+    def view(self,channel):
+        if numpy == None: raise ImportError("view() requires numpy")
+        offset = blockOffset(self.channels,self.slots,channel)
+        seq,count = self.counts(channel)
+        ring = numpy.frombuffer(self.map,dtype=DTYPE,count=self.slots,
+            offset=offset + COUNTS.size)
+        return ring,seq,count
+
+    # This function returns a copy of the latest n samples of a channel,
+    # or of all kept samples if n is None, oldest first.
+    def window(self,channel,n=None):
+        offset = (blockOffset(self.channels,self.slots,channel) +
+            COUNTS.size)
+        def read(count):
+            kept = min(count,self.slots if n == None else min(n,self.slots))
+            first = (count - kept) % self.slots
+            slots = [(first + i) % self.slots for i in range(kept)]
+            if numpy != None:
+                ring = numpy.frombuffer(self.map,dtype=DTYPE,
+                    count=self.slots,offset=offset)
+                return ring[slots]
+            return [unpackSample(self.map,offset + i*SAMPLE.size)
+                for i in slots]
+        return self.consistent(channel,read)
+
+    # This function closes the map and the file.
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
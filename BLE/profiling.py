@@ -0,0 +1,230 @@
+
+# profiling.py
+
+# This file times the stages of btpressure.py and bscan.py while they
+# run, to find which stage takes up the processor late into a long run.
+# Timing is off unless asked for, and a stage then costs one check. When
+# on, the time taken by each call of a named span is kept in a rolling
+# histogram of the last hour, from which percentiles are reported, and
+# each call can also be written to a trace file. A profile of everything
+# the program does can be taken for a set number of seconds, with
+# cProfile, or with pyinstrument if it is installed. cProfile only runs
+# within blocks of work, such as a timer tick, so the time spent waiting
+# in Tk or between windows is left out; pyinstrument samples throughout.
+# Either only profiles the main thread, not the scan threads.
+
+# Timing is turned on by the environment:
+#   TPMS_PROFILE=1   keeps the histograms, shown and written with the
+#                    metrics
+#   TPMS_TRACE=path  also writes every span to a trace file, which can be
+#                    opened with chrome://tracing or Perfetto
+# In btpressure.py, press p when not editing to profile for a minute. In
+# bscan.py, send the process SIGUSR1. The profile is written next to the
+# data file, as .prof for cProfile (read it with python -m pstats) or
+# .html for pyinstrument.
+
+
+import contextlib
+import json
+import math
+import os
+import time
+
+# pyinstrument is optional, and cProfile is used without it
+try: import pyinstrument
+except ImportError: pyinstrument = None
+import cProfile
+
+from telemetry import ms
+
+# span times are kept in buckets of powers of two, from a microsecond
+BUCKETS = 32 # the last bucket holds everything over about 35 minutes
+SMALLEST = 1e-6 # seconds
+
+# This function returns the bucket of a time in seconds.
+def bucket(seconds):
+    if seconds < SMALLEST: return 0
+    return min(BUCKETS-1,int(math.log(seconds/SMALLEST,2)) + 1)
+
+# This function returns the largest time in a bucket, in seconds.
+def bucketTop(idx):
+    return SMALLEST * 2**idx
+
+# This class counts the times of a span in buckets, over the last periods
+# intervals of period seconds, so that old times roll out of it.
+class RollingHistogram(object):
+
+    def __init__(self,period=600.0,periods=6,clock=time.time):
+        self.period = period
+        self.clock = clock
+        # bucket counts of each interval, the last being the current one
+        self.counts = [[0]*BUCKETS for i in range(periods)]
+        self.highs = [0.0]*periods # longest time of each interval
+        self.current = int(clock() // period) # number of the interval
+
+    # This function moves to the interval of now, clearing the ones ended.
+    def roll(self,now):
+        interval = int(now // self.period)
+        for i in range(min(interval - self.current,len(self.counts))):
+            self.counts.pop(0)
+            self.counts.append([0]*BUCKETS)
+            self.highs.pop(0)
+            self.highs.append(0.0)
+        self.current = max(self.current,interval)
+
+    # This function adds a time, in seconds.
+    def add(self,seconds):
+        self.roll(self.clock())
+        self.counts[-1][bucket(seconds)] += 1
+        self.highs[-1] = max(self.highs[-1],seconds)
+
+    # This function returns the count in each bucket over all intervals.
+    def totals(self):
+        self.roll(self.clock())
+        return [sum(counts[i] for counts in self.counts)
+            for i in range(BUCKETS)]
+
+    # This function returns the number of times kept.
+    def count(self):
+        return sum(self.totals())
+
+    # This function returns the longest of the times kept.
+    def high(self):
+        self.roll(self.clock())
+        return max(self.highs)
+
+    # This function returns the time that the fraction q of the times kept
+    # are no longer than, as the top of its bucket, or None if there are
+    # none.
+    def percentile(self,q):
+        totals = self.totals()
+        total = sum(totals)
+        if total == 0: return None
+        seen = 0
+        for i in range(BUCKETS):
+            seen += totals[i]
+            if seen >= q*total: return bucketTop(i)
+        return bucketTop(BUCKETS-1)
+
+# This class keeps the spans of a program and takes profiles. When not
+# enabled, spans are not timed.
+class Profiler(object):
+
+    def __init__(self,enabled=False,tracePath=None):
+        self.enabled = enabled or tracePath != None
+        self.spans = dict() # name -> RollingHistogram
+        self.trace = None
+        if tracePath != None:
+            self.trace = open(tracePath, "at")
+            # the closing bracket is optional in a trace file
+            if self.trace.tell() == 0: self.trace.write("[\n")
+        self.profile = None # profile being taken, if any
+        self.profileEnd = None # time the profile ends
+        self.profilePath = None # path the profile is written to
+        self.lastProfile = None # path of the last profile written
+
+    # This function returns a profiler set up by the TPMS_PROFILE and
+    # TPMS_TRACE environment variables.
+    @staticmethod
+    def fromEnvironment():
+        return Profiler(os.environ.get("TPMS_PROFILE","") not in ("","0"),
+            os.environ.get("TPMS_TRACE") or None)
+
+    # This function records that the named span took seconds, from start
+    # (seconds since the epoch).
+    def record(self,name,start,seconds):
+        histogram = self.spans.get(name)
+        if histogram == None:
+            histogram = self.spans[name] = RollingHistogram()
+        histogram.add(seconds)
+        if self.trace != None:
+            self.trace.write(json.dumps({"name":name,"ph":"X",
+                "ts":int(start*1e6),"dur":int(seconds*1e6),"pid":os.getpid(),
+                "tid":0}) + ",\n")
+
+    # This function times the code of a with block as the named span.
+    @contextlib.contextmanager
+    def span(self,name):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try: yield
+        finally: self.record(name,start,time.time() - start)
+
+    # This function starts a profile of the given number of seconds, to be
+    # written to path, without its extension. A profile already being
+    # taken is not restarted.
+    def startProfile(self,seconds,path):
+        if self.profile != None: return
+        self.profileEnd = time.time() + seconds
+        if pyinstrument != None:
+            self.profile = pyinstrument.Profiler()
+            self.profilePath = path + ".html"
+            self.profile.start()
+        else:
+            # enabled only within blocks of work
+            self.profile = cProfile.Profile()
+            self.profilePath = path + ".prof"
+
+    # This function profiles the code of a with block with cProfile, if a
+    # profile is being taken.
+    @contextlib.contextmanager
+    def work(self):
+        if self.profile == None or pyinstrument != None:
+            yield
+            return
+        profile = self.profile # may be written and let go within
+        profile.enable()
+        try: yield
+        finally: profile.disable()
+
+    # This function ends the profile being taken if its time is up, and
+    # writes it.
+    def poll(self):
+        if self.profile == None or time.time() < self.profileEnd: return
+        if pyinstrument != None:
+            self.profile.stop()
+            with open(self.profilePath, "wt") as f:
+                f.write(self.profile.output_html())
+        else: self.profile.dump_stats(self.profilePath)
+        self.lastProfile = self.profilePath
+        self.profile = None
+
+    # This function returns the count, percentiles, and longest time of
+    # each span over the last hour, in seconds, as a dictionary.
+    def snapshot(self):
+        spans = dict()
+        for name,histogram in self.spans.items():
+            spans[name] = {"count":histogram.count(),
+                "p50":histogram.percentile(0.5),
+                "p95":histogram.percentile(0.95),
+                "p99":histogram.percentile(0.99),"max":histogram.high()}
+        return spans
+
+    # This function returns the spans and the state of the profile as
+    # lines of text.
+    def lines(self):
+        lines = []
+        spans = self.snapshot()
+        for name in sorted(spans):
+            span = spans[name]
+            lines.append("%s: %d in the last hour, p50 %s ms, p95 %s ms, "
+                "p99 %s ms, max %s ms" % (name,span["count"],ms(span["p50"]),
+                ms(span["p95"]),ms(span["p99"]),ms(span["max"])))
+        if self.profile != None:
+            lines.append("profiling for %.0f s more" % max(0,
+                self.profileEnd - time.time()))
+        elif self.lastProfile != None:
+            lines.append("profile written to " + self.lastProfile)
+        return lines
+
+    # This function writes the profile being taken, if any, and closes the
+    # trace file.
+    def close(self):
+        if self.profile != None:
+            self.profileEnd = 0
+            self.poll()
+        if self.trace != None:
+            self.trace.close()
+            self.trace = None
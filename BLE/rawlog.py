@@ -0,0 +1,243 @@
+
+# rawlog.py
+
+# This file keeps every decoded sample in a compact binary log, written by
+# bscan.py. Each sample is a fixed size record of time, pressure,
+# temperature, raw pressure and temperature counts, and channel, after a
+# short header. Records are only ever appended, so a log is never
+# rewritten, and a record cut short by a crash is dropped the next time
+# the log is opened for writing.
+
+# A log is read through a memory map, so opening it takes the same time
+# however long the run. With numpy installed, the records are viewed as
+# arrays without being copied or parsed. The text file of a run, as
+# written by btpressure.py, can be made from a log when it is needed.
+
+# To export a log to a run file:
+#   > python rawlog.py samples.bin -o run.txt [--spacing 3] [--process]
+
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import threading
+
+# numpy is optional, and only needed for array views of the records
+try: import numpy
+except ImportError: numpy = None
+
+from tpms import loadRegistry, roundArray, SENSOR_FILE
+from runfile import RunWriter, processFile
+
+# start of every log, followed by the record size
+MAGIC = b"TPMSLOG1"
+HEADER = struct.Struct("<8sI4x")
+# time (seconds since the epoch), pressure, temperature, raw pressure
+# count, raw temperature count, and channel
+RECORD = struct.Struct("<dffIIH6x")
+FIELDS = ("time","pressure","temp","rawPressure","rawTemp","channel")
+
+# the layout of a record, as a numpy type
+if numpy != None:
+    DTYPE = numpy.dtype({"names":list(FIELDS),
+        "formats":["<f8","<f4","<f4","<u4","<u4","<u2"],
+        "offsets":[0,8,12,16,20,24],"itemsize":RECORD.size})
+else: DTYPE = None
+
+# This function reads the header of a log, and raises ValueError if the
+# file is not a log of this format.
+def checkHeader(f):
+    f.seek(0)
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size: raise ValueError("log has no header")
+    magic,size = HEADER.unpack(header)
+    if magic != MAGIC or size != RECORD.size:
+        raise ValueError("not a sample log: " + f.name)
+
+# This class appends samples to a log. Samples are written by the scan
+# threads of all adapters, so writes are locked. Written records reach the
+# file on flush, and the disk as well if sync is set.
+class LogWriter(object):
+
+    def __init__(self,path,sync=False):
+        self.path = path
+        self.sync = sync # whether flushes wait for the disk
+        self.lock = threading.Lock()
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        if size > 0:
+            with open(path, "r+b") as f:
+                checkHeader(f)
+                # drops a record cut short by a crash
+                whole = (size - HEADER.size) // RECORD.size
+                f.truncate(HEADER.size + whole * RECORD.size)
+        self.file = open(path, "ab")
+        if size == 0:
+            self.file.write(HEADER.pack(MAGIC,RECORD.size))
+            self.flush()
+
+    # This function appends one sample, with the raw counts it was
+    # converted from.
+    def write(self,t,channel,pressure,temp,raw):
+        record = RECORD.pack(t,pressure,temp,raw[0],raw[1],channel)
+        with self.lock:
+            self.file.write(record)
+
+    # This function pushes all written records to the file.
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            if self.sync: os.fsync(self.file.fileno())
+
+    # This function flushes and closes the file.
+    def close(self):
+        if self.file.closed: return
+        self.flush()
+        self.file.close()
+
+# This class reads a log through a memory map. Only the records present
+# when the log is opened are seen. Records are returned as tuples in the
+# order of FIELDS, or as a numpy record array with records(). Arrays view
+# the map directly, so they must be let go of before the log is closed.
+class LogReader(object):
+
+    def __init__(self,path):
+        self.path = path
+        self.file = open(path, "rb")
+        checkHeader(self.file)
+        size = os.fstat(self.file.fileno()).st_size
+        self.count = (size - HEADER.size) // RECORD.size
+        self.map = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self,i):
+        if i < 0: i += self.count
+        if not 0 <= i < self.count: raise IndexError("record out of range")
+        return self.unpack(i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.unpack(i)
+
+    # This function returns record i as a tuple in the order of FIELDS.
+    def unpack(self,i):
+        t,pressure,temp,pDec,tDec,channel = RECORD.unpack_from(self.map,
+            HEADER.size + i * RECORD.size)
+        # the values were rounded to a tenth before being stored as floats
+        return t,round(pressure,1),round(temp,1),pDec,tDec,channel
+
+    # This function returns all records as a numpy record array, without
+    # copying them.
+    def records(self):
+        if numpy == None: raise ImportError("records() requires numpy")
+        return numpy.frombuffer(self.map,dtype=DTYPE,count=self.count,
+            offset=HEADER.size)
+
+    # This function returns one field of all records as a numpy array,
+    # without copying it.
+    def column(self,name):
+        return self.records()[name]
+
+    # This function closes the map and the file.
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+# This function returns the average of each channel's pressure and
+# temperature in each period of spacing minutes, as a dictionary of
+# (period,channel) -> (pressure,temp). Period k covers the k-th spacing
+# minutes after the start.
+def periodAverages(log,start,spacing):
+    if numpy != None:
+        records = log.records()
+        periods = ((records["time"] - start) // (60.0 * spacing)).astype(int)
+        keep = periods >= 0
+        periods,channels = periods[keep],records["channel"][keep]
+        pressures = records["pressure"][keep].astype(float)
+        temps = records["temp"][keep].astype(float)
+        # a key for every (period,channel) pair, counted in one pass
+        width = int(channels.max()) + 1 if len(channels) > 0 else 1
+        keys = periods * width + channels
+        found,index = numpy.unique(keys,return_inverse=True)
+        counts = numpy.bincount(index)
+        pAvg = roundArray(numpy.bincount(index,numpy.round(pressures,1))
+            / counts)
+        tAvg = roundArray(numpy.bincount(index,numpy.round(temps,1))
+            / counts)
+        return dict(((int(key) // width,int(key) % width),(p,t))
+            for key,p,t in zip(found,pAvg.tolist(),tAvg.tolist()))
+    sums = dict()
+    for t,pressure,temp,pDec,tDec,channel in log:
+        if t < start: continue
+        key = int((t - start) // (60.0 * spacing)),channel
+        total = sums.setdefault(key,[0.0,0.0,0])
+        total[0] += pressure
+        total[1] += temp
+        total[2] += 1
+    return dict((key,(round(p/n,1),round(temp/n,1)))
+        for key,(p,temp,n) in sums.items())
+
+# This function writes the samples of a log as the text file of a run, in
+# the same layout as btpressure.py: one row of averages every spacing
+# minutes from the first sample, or from start (seconds since the epoch)
+# if given, with the filler where a channel has no samples. Only
+# channels with a label in the registry are written.
+def exportCsv(logPath,registry,out,spacing=3,start=None,filler="None"):
+    channels = [sensor.channel for sensor in registry.sensors
+        if sensor.label != ""]
+    header = "Time" + "".join("," + registry.sensors[i].label + ",Temp"
+        for i in channels)
+    with LogReader(logPath) as log:
+        if len(log) == 0: averages,last = dict(),-1
+        else:
+            if start == None: start = log[0][0]
+            averages = periodAverages(log,start,spacing)
+            last = max([key[0] for key in averages] + [-1])
+    # the run file is written whole, replacing any earlier export
+    temp = out + ".tmp"
+    if os.path.isfile(temp): os.remove(temp)
+    writer = RunWriter(temp,header,flushEvery=1000,sync=False)
+    for period in range(last+1):
+        row = "\n" + str(round((period+1)*spacing,2))
+        for i in channels:
+            average = averages.get((period,i))
+            if average == None: row += "," + filler + "," + filler
+            else: row += "," + str(average[0]) + "," + str(average[1])
+        writer.write(row)
+    writer.close()
+    os.rename(temp,out)
+
+# This function reads the command line options.
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description="Export a sample log to the text file of a run.")
+    parser.add_argument("log",help="sample log written by bscan.py")
+    parser.add_argument("-o","--out",default="run.txt",
+        help="run file to write (default run.txt)")
+    parser.add_argument("-r","--registry",default=SENSOR_FILE,
+        help="file listing the sensors (default sensors.csv)")
+    parser.add_argument("--spacing",type=float,default=3,
+        help="minutes between rows (default 3)")
+    parser.add_argument("--process",action="store_true",
+        help="fill in missing points by linear interpolation")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(sys.argv[1:] if argv == None else argv)
+    registry = loadRegistry(args.registry)
+    exportCsv(args.log,registry,args.out,args.spacing)
+    if args.process:
+        labelled = len([label for label in registry.labels() if label != ""])
+        processFile(args.out,"None",[0]*labelled,[0]*labelled)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+
+# reprocess.py
+
+# This file runs the post-processing of btpressure.py over archived run
+# files, without the user interface: missing points are filled in by
+# linear interpolation, from new baselines if asked. Files are processed
+# in parallel, one per process, and each is streamed one line at a time,
+# so memory does not grow with the length of the runs. The time taken by
+# each file is reported as it finishes.
+
+# To run:
+#   > python reprocess.py runs/ [more runs or files] -o processed/
+#   - without -o, each file is replaced by its processed version
+#   - --baseline 1.2,0.8,... gives the baseline pressure of each dataset,
+#       or --window 0 10 averages each dataset over minutes 0 to 10 of
+#       its own run to find them; the baselines are 0 otherwise
+#   - --subtract also subtracts the baseline from every pressure
+#   - --jobs sets the number of processes (default all cores)
+
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+from runfile import processFile
+
+# This function determines if a file is a run file, by its top line.
+def isRunFile(path):
+    with open(path, "rt") as f:
+        return f.readline().startswith("Time,")
+
+# This function returns the run files to process: the given files, and
+# the .txt files in the given directories, leaving out files that are not
+# run files, such as the sample files of bscan.py. Given files that are
+# left out are reported; a given file that does not exist is kept, to be
+# reported as failed.
+def runFiles(paths):
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += [os.path.join(path,name) for name in
+                sorted(os.listdir(path)) if name.endswith(".txt") and
+                isRunFile(os.path.join(path,name))]
+        elif os.path.isfile(path) and not isRunFile(path):
+            print("skipped, not a run file: %s" % path)
+        else: found.append(path)
+    return found
+
+# This function returns the mean pressure and temperature of each dataset
+# of a run file over lb <= time <= ub, in minutes, with 0 where a dataset
+# has no points. The file is read one line at a time.
+def windowMeans(path,filler,lb,ub):
+    with open(path, "rt") as f:
+        top = f.readline().rstrip("\n").split(",")
+        sums,counts = [0.0]*len(top),[0]*len(top)
+        for line in f:
+            row = line.rstrip("\n").split(",")
+            if row == [""]: continue
+            if not lb <= float(row[0]) <= ub: continue
+            for j in range(1,len(row)):
+                if row[j] == filler: continue
+                sums[j] += float(row[j])
+                counts[j] += 1
+    means = [round(sums[j]/counts[j],1) if counts[j] > 0 else 0
+        for j in range(len(top))]
+    return means[1::2],means[2::2]
+
+# This function processes one run file as given by the options, and
+# returns the path, the seconds taken, and the error, if any.
+def reprocess(job):
+    path,args = job
+    start = time.time()
+    try:
+        with open(path, "rt") as f:
+            datasets = (len(f.readline().split(",")) - 1)//2
+        if args.window != None:
+            baseline,basetemp = windowMeans(path,args.filler,*args.window)
+        else:
+            baseline = args.baseline or []
+            baseline = (baseline + [0]*datasets)[:datasets]
+            basetemp = [0]*datasets
+        out = None if args.out == None else os.path.join(args.out,
+            os.path.basename(path))
+        processFile(path,args.filler,baseline,basetemp,out,args.subtract)
+        return path,time.time() - start,None
+    # any error fails only this file, and is reported with it
+    except Exception as e:
+        return path,time.time() - start,"%s: %s" % (type(e).__name__,e)
+
+# This function reads a comma separated list of baselines.
+def baselines(text):
+    return [float(value) for value in text.split(",")]
+
+# This function reads the command line options.
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description="Fill in missing points of archived run files.")
+    parser.add_argument("paths",nargs="+",
+        help="run files, or directories of .txt run files")
+    parser.add_argument("-o","--out",
+        help="directory to write the processed files to (default in place)")
+    parser.add_argument("-f","--filler",default="None",
+        help="text of a missing point (default None)")
+    baseline = parser.add_mutually_exclusive_group()
+    baseline.add_argument("-b","--baseline",type=baselines,
+        help="comma separated baseline pressure of each dataset")
+    baseline.add_argument("-w","--window",type=float,nargs=2,
+        metavar=("LB","UB"),
+        help="minutes of each run to average for the baselines")
+    parser.add_argument("-s","--subtract",action="store_true",
+        help="subtract the baseline from every pressure")
+    parser.add_argument("-j","--jobs",type=int,default=None,
+        help="number of processes (default the number of cores)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(sys.argv[1:] if argv == None else argv)
+    paths = runFiles(args.paths)
+    if args.out != None and not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    start = time.time()
+    pool = multiprocessing.Pool(args.jobs)
+    failed = 0
+    try:
+        for path,seconds,error in pool.imap_unordered(reprocess,
+            [(path,args) for path in paths]):
+            if error == None: print("%8.2f s  %s" % (seconds,path))
+            else:
+                failed += 1
+                print("%8.2f s  %s failed: %s" % (seconds,path,error))
+    finally:
+        pool.close()
+        pool.join()
+    print("%d files in %.2f s, %d failed" % (len(paths),
+        time.time() - start,failed))
+    return 1 if failed > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
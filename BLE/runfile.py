@@ -0,0 +1,170 @@
+
+# runfile.py
+
+# This file writes the text file of a run. The file has a top line of
+# dataset names, followed by lines with time followed by pressure and
+# temperature data for each dataset, with points separated by commas.
+# Rows are appended to an open file, so saving only costs as much as the
+# data gathered since the last save. After the run, missing points are
+# filled in by a single streaming pass over the file.
+
+
+import os
+import collections
+
+# This class appends rows to the output file of a run. The header line is
+# only written if the file is new or empty, so continuing an existing file
+# adds to its end. Each written block of rows starts with a newline, so
+# the file never ends with one.
+class RunWriter(object):
+
+    def __init__(self,path,header,flushEvery=1,sync=True):
+        self.path = path
+        self.flushEvery = flushEvery # writes between flushes to disk
+        self.sync = sync # whether flushes wait for the disk
+        self.pending = 0 # writes since the last flush
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        # an existing file that ends in a newline continues on that line
+        self.skipNewline = size > 0 and lastChar(path) == "\n"
+        self.file = open(path, "at")
+        if size == 0:
+            self.file.write(header)
+            self.flush()
+
+    # This function appends a block of rows, each starting with a newline.
+    def write(self,rows):
+        if rows == "": return
+        if self.skipNewline:
+            rows = rows[1:] if rows.startswith("\n") else rows
+            self.skipNewline = False
+        self.file.write(rows)
+        self.pending += 1
+        if self.pending >= self.flushEvery: self.flush()
+
+    # This function pushes all written rows to the file on disk.
+    def flush(self):
+        self.file.flush()
+        if self.sync: os.fsync(self.file.fileno())
+        self.pending = 0
+
+    # This function flushes and closes the file.
+    def close(self):
+        if self.file.closed: return
+        self.flush()
+        self.file.close()
+
+# This function returns the last character of a file.
+def lastChar(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1).decode("ascii","replace")
+
+# This function uses linear interpolation using two points and a value 
+# which are strings of floats. It outputs the calculated value as a string.
+def interpolate(filler,x1,x2,y1,y2,x):
+    if filler in (x1,x2,y1,y2,x): return filler
+    return str(round(float(y1)+(float(x)-
+        float(x1))*(float(y2)-float(y1))/(float(x2)-float(x1)),2))
+
+# This function returns the position of the last row, after the top
+# line, with a value in each column, or -1 where a column has none. There
+# are no columns if there is no top line.
+def lastValues(rows,filler):
+    rows = iter(rows)
+    top = next(rows,None)
+    if top == None: return []
+    last = [-1] * len(top)
+    for i,row in enumerate(rows):
+        for j in range(1,len(row)):
+            if row[j] != filler: last[j] = i
+    return last
+
+# This function replaces the missing points of each row, given as lists
+# of strings, with linearly interpolated points, and yields the rows in
+# order. The first row is the top line of dataset names. The initial
+# point of each column is a time of 0 with the baseline pressure or
+# temperature. Only rows inside an open gap of some column are held
+# back, so memory grows with the longest gap and not the run. Missing
+# points after the last value of a column are left as the filler. If
+# last is given, as found by lastValues, a missing point after the last
+# value of its column does not hold its row back; otherwise every row
+# after it is held until the end, as the gap is never closed.
+def interpolateRows(rows,filler,baseline,basetemp,last=None):
+    rows = iter(rows)
+    top = next(rows,None)
+    # an empty file is passed through
+    if top == None: return
+    yield top
+    # lower bound point of each column
+    lower = [None]
+    for j in range(1,len(top)):
+        if j % 2 == 1: lower.append((0,baseline[(j-1)//2]))
+        else: lower.append((0,basetemp[(j-1)//2]))
+    # rows missing a point in each column since its lower bound
+    gaps = [[] for j in range(len(top))]
+    # held back rows, each with its number of missing points
+    waiting = collections.deque()
+    for i,row in enumerate(rows):
+        entry = [row,0]
+        for j in range(1,len(top)):
+            if row[j] == filler:
+                if last != None and i > last[j]: continue
+                gaps[j].append(entry)
+                entry[1] += 1
+                continue
+            # this point is the upper bound for the gap in the column
+            for gap in gaps[j]:
+                gap[0][j] = interpolate(filler,lower[j][0],row[0],
+                    lower[j][1],row[j],gap[0][0])
+                gap[1] -= 1
+            gaps[j] = []
+            lower[j] = row[0],row[j]
+        waiting.append(entry)
+        while waiting and waiting[0][1] == 0:
+            yield waiting.popleft()[0]
+    for entry in waiting:
+        yield entry[0]
+
+# This function subtracts the baseline from each pressure of the rows
+# after the top line, leaving missing points as the filler.
+def subtractRows(rows,filler,baseline):
+    rows = iter(rows)
+    top = next(rows,None)
+    if top == None: return
+    yield top
+    for row in rows:
+        for j in range(1,len(row),2):
+            if row[j] == filler: continue
+            row[j] = str(round(float(row[j]) - baseline[(j-1)//2],2))
+        yield row
+
+# This function runs post-processing on the text file to replace all 
+# missing points within the run with linearly interpolated points.
+# After processing, the only non-values will be at the end of the file,
+# when no more data was received from said sensor before ending the run.
+# If subtract is set, the baseline is then subtracted from each pressure.
+# The file is read twice, one line at a time: first to find the last
+# value of each column, then to write the processed file, which replaces
+# the original (or is written to out) once it is complete, and is removed
+# if processing fails.
+def processFile(path,filler,baseline,basetemp,out=None,subtract=False):
+    if out == None: out = path
+    temp = out + ".tmp"
+    with open(path, "rt") as f:
+        last = lastValues((line.rstrip("\n").split(",") for line in f),
+            filler)
+    try:
+        with open(path, "rt") as f:
+            with open(temp, "wt") as g:
+                rows = (line.rstrip("\n").split(",") for line in f)
+                rows = interpolateRows(rows,filler,baseline,basetemp,last)
+                if subtract: rows = subtractRows(rows,filler,baseline)
+                first = True
+                for row in rows:
+                    if not first: g.write("\n")
+                    g.write(",".join(row))
+                    first = False
+        os.rename(temp,out)
+    finally:
+        # a file that failed part way is not left behind
+        if os.path.isfile(temp): os.remove(temp)
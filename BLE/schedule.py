@@ -0,0 +1,94 @@
+
+# schedule.py
+
+# This file keeps the deadlines of periodic work, such as adding a point
+# every few minutes or saving the run file. Deadlines fall at whole
+# multiples of their period from their start, on a monotonic clock, so
+# they do not drift by the time taken to act on them, and are not moved
+# when the wall clock is set. A deadline that is passed more than once
+# before being checked is acted on once, and the ones skipped are counted
+# as missed. The caller can sleep until the next deadline instead of
+# checking on a fixed tick.
+
+
+from series import RunningStats
+
+# the monotonic clock, in seconds; before Python 3.3 there is only the
+# wall clock
+try: from time import monotonic
+except ImportError: from time import time as monotonic
+
+# This class is one periodic deadline.
+class Deadline(object):
+
+    def __init__(self,period,start):
+        self.period = period # seconds between deadlines
+        self.start = start # time the deadlines are counted from
+        self.count = 0 # deadlines since start acted on or missed
+        self.missed = 0 # deadlines passed without being acted on
+        self.late = RunningStats() # seconds each was acted on late
+
+    # This function returns the time of the last deadline acted on, or
+    # the start if there is none.
+    def last(self):
+        return self.start + self.count*self.period
+
+    # This function returns the time of the next deadline.
+    def next(self):
+        return self.last() + self.period
+
+    # This function determines if a deadline has passed since the last
+    # one acted on. If so, the latest passed deadline is taken as acted
+    # on, and any before it as missed.
+    def due(self,now):
+        if now < self.next(): return False
+        passed = int((now - self.last())//self.period)
+        self.count += passed
+        self.missed += passed - 1
+        self.late.add(now - self.last())
+        return True
+
+    # This function changes the period, with the next deadlines counted
+    # from the last one acted on.
+    def setPeriod(self,period):
+        self.start = self.last()
+        self.count = 0
+        self.period = period
+
+# This class holds named deadlines.
+class Schedule(object):
+
+    def __init__(self,clock=monotonic):
+        self.clock = clock
+        self.deadlines = dict()
+
+    def __contains__(self,name):
+        return name in self.deadlines
+
+    def __getitem__(self,name):
+        return self.deadlines[name]
+
+    # This function adds a deadline every period seconds from start, or
+    # from now, replacing any of the same name.
+    def add(self,name,period,start=None):
+        if start == None: start = self.clock()
+        self.deadlines[name] = Deadline(period,start)
+        return self.deadlines[name]
+
+    # This function removes a deadline, if there is one of the name.
+    def remove(self,name):
+        self.deadlines.pop(name,None)
+
+    # This function determines if the named deadline has passed, as in
+    # Deadline.due. A deadline that does not exist is never due.
+    def due(self,name,now=None):
+        if name not in self.deadlines: return False
+        return self.deadlines[name].due(self.clock() if now == None else now)
+
+    # This function returns the seconds until the next deadline, or None
+    # if there are no deadlines.
+    def wait(self,now=None):
+        if self.deadlines == {}: return None
+        if now == None: now = self.clock()
+        soonest = min(deadline.next() for deadline in self.deadlines.values())
+        return max(0.0,soonest - now)
@@ -0,0 +1,274 @@
+
+# series.py
+
+# This file stores the points of each dataset in columns: one array of
+# times and one array of values, both as packed doubles. This takes a
+# fraction of the memory of a list of (x,y) tuples. As the times are in
+# order, the points in a time range are found by binary search, and a
+# running sum of the values gives their mean without reading them.
+# Datasets shifted by a baseline are views of the stored points, not
+# copies. The samples between two points are summarised as they arrive,
+# and never stored, and so is the log-linear fit of each dataset.
+
+
+from array import array
+from bisect import bisect_left, bisect_right
+import math
+
+# This class defines a single dataset, with times in increasing order.
+class Series(object):
+
+    def __init__(self,points=()):
+        self.times = array("d") # x data
+        self.values = array("d") # y data
+        self.sums = array("d",[0.0]) # sums[i] is the sum of values[:i]
+        for (x,y) in points:
+            self.add(x,y)
+
+    def __len__(self):
+        return len(self.times)
+
+    # This function adds a new point to the end of the dataset.
+    def add(self,x,y):
+        self.times.append(x)
+        self.values.append(y)
+        self.sums.append(self.sums[-1] + y)
+
+    # This function returns the (x,y) points of the dataset in order.
+    def points(self):
+        return self.pointsFrom(0)
+
+    # This function returns the (x,y) points of the dataset in order,
+    # starting from the given position.
+    def pointsFrom(self,start):
+        for i in range(start,len(self.times)):
+            yield self.times[i],self.values[i]
+
+    # This function removes the points at the given positions.
+    def remove(self,positions):
+        for i in sorted(positions,reverse=True):
+            self.times.pop(i)
+            self.values.pop(i)
+        # the sums after the first removed point are made again
+        self.sums = array("d",[0.0])
+        for y in self.values:
+            self.sums.append(self.sums[-1] + y)
+
+    # This function returns the positions of the first point with
+    # lb <= x and of the first point after those with x <= ub. A bound of
+    # None is open.
+    def span(self,lb,ub):
+        lo = 0 if lb == None else bisect_left(self.times,lb)
+        hi = len(self.times) if ub == None else bisect_right(self.times,ub)
+        return lo,max(lo,hi)
+
+    # This function returns the (x,y) points with lb <= x <= ub in order.
+    def between(self,lb,ub):
+        lo,hi = self.span(lb,ub)
+        for i in range(lo,hi):
+            yield self.times[i],self.values[i]
+
+    # This function returns the mean value of all points with
+    # lb <= x <= ub, or None if there are none.
+    def mean(self,lb,ub):
+        lo,hi = self.span(lb,ub)
+        if hi == lo: return None
+        return (self.sums[hi] - self.sums[lo])/(hi - lo)
+
+# This class holds one series per dataset, adding datasets as needed.
+class SeriesStore(object):
+
+    def __init__(self,channels=0):
+        self.series = [Series() for i in range(channels)]
+
+    def __len__(self):
+        return len(self.series)
+
+    def __getitem__(self,idx):
+        return self.series[idx]
+
+    # This function adds a point to the given dataset.
+    def add(self,idx,point):
+        while len(self.series) <= idx:
+            self.series.append(Series())
+        x,y = point
+        self.series[idx].add(x,y)
+
+    # This function determines if no dataset has any points.
+    def isEmpty(self):
+        for series in self.series:
+            if len(series) > 0: return False
+        return True
+
+# This class presents a single dataset with an offset subtracted from
+# every value, without copying the points.
+class OffsetSeries(object):
+
+    def __init__(self,series,offset):
+        self.series = series
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.series)
+
+    # This function returns the shifted (x,y) points of the dataset.
+    def points(self):
+        return self.pointsFrom(0)
+
+    # This function returns the shifted (x,y) points of the dataset,
+    # starting from the given position.
+    def pointsFrom(self,start):
+        for (x,y) in self.series.pointsFrom(start):
+            yield x,y - self.offset
+
+    # This function returns the shifted (x,y) points with lb <= x <= ub.
+    def between(self,lb,ub):
+        for (x,y) in self.series.between(lb,ub):
+            yield x,y - self.offset
+
+    # This function returns the shifted mean value of all points with
+    # lb <= x <= ub, or None if there are none.
+    def mean(self,lb,ub):
+        avg = self.series.mean(lb,ub)
+        if avg == None: return None
+        return avg - self.offset
+
+# This class presents a SeriesStore with one offset subtracted from each
+# dataset, such as a baseline. The points stay in the underlying store, so
+# changing the offsets costs one step per dataset, not per point.
+class OffsetStore(object):
+
+    def __init__(self,store):
+        self.store = store # underlying SeriesStore
+        self.offsets = [] # missing offsets are 0
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self,idx):
+        return OffsetSeries(self.store[idx],self.offset(idx))
+
+    # This function returns the offset of the given dataset.
+    def offset(self,idx):
+        if idx < len(self.offsets): return self.offsets[idx]
+        return 0
+
+    # This function replaces the offsets of all datasets.
+    def setOffsets(self,offsets):
+        self.offsets = list(offsets)
+
+    # The shifted datasets are read only: points are added to the
+    # underlying store, so that they are never written shifted.
+    def add(self,idx,point):
+        raise TypeError("points are added to the underlying store, "
+            "not to an OffsetStore")
+
+    # This function determines if no dataset has any points.
+    def isEmpty(self):
+        return self.store.isEmpty()
+
+# This class keeps the count, sum, lowest, highest, and variance of the
+# values added since it was last reset, without keeping the values. The
+# variance is updated by Welford's method, which stays accurate however
+# many values are added.
+class RunningStats(object):
+
+    def __init__(self):
+        self.reset()
+
+    def __len__(self):
+        return self.count
+
+    # This function forgets all values added.
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.low = self.high = None
+        self.mu = 0.0 # mean
+        self.m2 = 0.0 # sum of squared differences from the mean
+
+    # This function adds a value.
+    def add(self,x):
+        self.count += 1
+        self.total += x
+        if self.low == None or x < self.low: self.low = x
+        if self.high == None or x > self.high: self.high = x
+        delta = x - self.mu
+        self.mu += delta / self.count
+        self.m2 += delta * (x - self.mu)
+
+    # This function returns the average of the values rounded to a tenth,
+    # as in the data file, or None if there are none.
+    def average(self):
+        if self.count == 0: return None
+        return round(self.total/self.count,1)
+
+    # This function returns the average of the values, or None if there
+    # are none.
+    def mean(self):
+        if self.count == 0: return None
+        return self.mu
+
+    # This function returns the sample variance of the values, or None if
+    # there are fewer than two.
+    def variance(self):
+        if self.count < 2: return None
+        return self.m2 / (self.count - 1)
+
+# This class fits a line to the logarithm of the values of a dataset, as
+# for an exponential decay y = A*exp(-x/lifetime). Only the sums of the
+# least squares fit are kept, so each point costs one step to add, and the
+# fit costs one step to read however long the run. Only positive values
+# with lb <= x <= ub are fitted, where a bound of None is open.
+class LogFit(object):
+
+    def __init__(self,lb=None,ub=None):
+        self.setBounds(lb,ub)
+
+    # This function forgets all points and sets the bounds of the fit.
+    def setBounds(self,lb,ub):
+        self.lb = lb
+        self.ub = ub
+        self.count = 0
+        self.sx = self.sy = self.sxy = self.sxx = 0.0
+
+    # This function determines if x is within the bounds of the fit.
+    def inBound(self,x):
+        if self.lb != None and x < self.lb: return False
+        if self.ub != None and x > self.ub: return False
+        return True
+
+    # This function adds a point, if it is within the bounds and its
+    # value has a logarithm.
+    def add(self,x,y):
+        if y == None or y <= 0 or not self.inBound(x): return
+        ly = math.log(y)
+        self.count += 1
+        self.sx += x
+        self.sy += ly
+        self.sxy += x*ly
+        self.sxx += x*x
+
+    # This function forgets all points and fits the given (x,y) points
+    # within the new bounds.
+    def refit(self,points,lb=None,ub=None):
+        self.setBounds(lb,ub)
+        for (x,y) in points:
+            self.add(x,y)
+
+    # This function returns the slope and intercept of the fitted line of
+    # log(y) against x, or None if the points do not determine a line.
+    def line(self):
+        n = self.count
+        if n < 2: return None
+        spread = n*self.sxx - self.sx*self.sx
+        if spread <= 0: return None
+        slope = (n*self.sxy - self.sx*self.sy)/spread
+        return slope,(self.sy - slope*self.sx)/n
+
+    # This function returns the lifetime of the fitted decay, in the
+    # units of x, or None if there is no fit or no decay or growth.
+    def lifetime(self):
+        line = self.line()
+        if line == None or line[0] == 0: return None
+        return -1.0/line[0]
@@ -0,0 +1,187 @@
+
+# simscan.py
+
+# This file provides scanners that stand in for bluepy's Scanner, so that
+# the acquisition pipeline can be run and measured without bluetooth
+# sensors or root access. SyntheticScanner makes up advertisements for the
+# known sensors, among any number of unrelated devices, with dropouts.
+# ReplayScanner plays back raw advertisements recorded by bscan.py.
+# Both are used through the same calls as Scanner: withDelegate, start,
+# process, stop, clear, getDevices, and scan.
+
+
+import random
+import time
+
+from tpms import encode
+
+# advertising data type of manufacturer data
+MANUFACTURER = 0xFF
+
+# This class stands in for bluepy's ScanEntry: a device and the last
+# manufacturer data heard from it.
+class SimEntry(object):
+
+    def __init__(self,addr,ManuData):
+        self.addr = addr
+        self.ManuData = ManuData
+        self.updateCount = 0
+
+    # This function returns the manufacturer data, the only data type the
+    # simulated devices advertise.
+    def getValueText(self,adtype):
+        if adtype == MANUFACTURER: return self.ManuData
+        return None
+
+    def getScanData(self):
+        return [(MANUFACTURER,"Manufacturer",self.ManuData)]
+
+# This class holds what the simulated scanners share with bluepy's
+# Scanner: the delegate, the devices seen since the last clear, and the
+# scan function.
+class SimScanner(object):
+
+    def __init__(self,iface=0):
+        self.iface = iface
+        self.delegate = None
+        self.scanned = dict()
+
+    def withDelegate(self,delegate):
+        self.delegate = delegate
+        return self
+
+    def clear(self):
+        self.scanned = dict()
+
+    def start(self,passive=False): pass
+
+    def stop(self): pass
+
+    def getDevices(self):
+        return list(self.scanned.values())
+
+    def scan(self,timeout=10,passive=False):
+        self.clear()
+        self.start(passive)
+        self.process(timeout)
+        self.stop()
+        return self.getDevices()
+
+    # This function passes one advertisement to the delegate.
+    def advertise(self,addr,ManuData):
+        dev = self.scanned.get(addr)
+        if dev == None:
+            dev = self.scanned[addr] = SimEntry(addr,ManuData)
+        dev.ManuData = ManuData
+        dev.updateCount += 1
+        if self.delegate != None:
+            self.delegate.handleDiscovery(dev,dev.updateCount == 1,True)
+
+# This class makes up advertisements. Every known sensor and every decoy
+# device advertises rate times a second. The pressure of each sensor
+# rises slowly with noise, and each of its advertisements is lost with
+# probability dropout. If realtime is False, process returns as soon as
+# the advertisements of the timeout have been made, so that the pipeline
+# can be run as fast as possible.
+class SyntheticScanner(SimScanner):
+
+    def __init__(self,registry,iface=0,rate=1.0,decoys=0,dropout=0.0,
+        realtime=True,seed=None):
+        SimScanner.__init__(self,iface)
+        self.sensors = registry.sensors # known sensors
+        self.rate = rate # advertisements per second per device
+        self.dropout = dropout # chance that an advertisement is lost
+        self.realtime = realtime # whether process takes its timeout
+        self.random = random.Random(seed)
+        self.decoys = [self.randomMac() for i in range(decoys)]
+        self.elapsed = 0.0 # simulated seconds since the first process
+        self.owed = 0.0 # fraction of an advertisement round not yet made
+
+    # This function makes up the address of an unrelated device.
+    def randomMac(self):
+        return ":".join("%02x" % self.random.randrange(256)
+            for i in range(6))
+
+    # This function returns the simulated pressure of a sensor.
+    def pressure(self,sensor):
+        drift = 0.01 * self.elapsed / 60.0 # psi per minute
+        noise = self.random.gauss(0,0.05)
+        return 14.7 + 0.5 * sensor.channel + drift + noise
+
+    # This function makes the advertisements of timeout seconds.
+    def process(self,timeout=10.0):
+        self.owed += timeout * self.rate
+        rounds = int(self.owed)
+        self.owed -= rounds
+        for i in range(rounds):
+            if self.realtime: time.sleep(1.0 / self.rate)
+            self.elapsed += 1.0 / self.rate
+            for sensor in self.sensors:
+                if self.random.random() < self.dropout: continue
+                temp = 22.0 + self.random.gauss(0,0.2)
+                self.advertise(sensor.mac,encode(self.pressure(sensor),
+                    temp,sensor.calibration))
+            for mac in self.decoys:
+                self.advertise(mac,"%032x" % self.random.getrandbits(128))
+        if self.realtime and rounds == 0: time.sleep(timeout)
+
+# This class plays back a file of raw advertisements recorded by bscan.py,
+# made of lines of time, MAC address, and manufacturer data separated by
+# commas. Each process call advances through timeout seconds of the
+# recording, scaled by speed. If realtime is False, process returns as
+# soon as the advertisements are passed on. Once the recording ends,
+# process does nothing unless loop is set.
+class ReplayScanner(SimScanner):
+
+    def __init__(self,path,iface=0,speed=1.0,realtime=True,loop=False):
+        SimScanner.__init__(self,iface)
+        self.path = path # recording to play back
+        self.speed = speed # recorded seconds per second of playback
+        self.realtime = realtime # whether process takes its timeout
+        self.loop = loop # whether to start over at the end
+        self.file = None
+        self.next = None # next advertisement, as (time,mac,data)
+        self.clock = None # time in the recording played back so far
+        self.first = self.last = None # recorded times of the recording
+        self.shift = 0.0 # added to recorded times, when looping
+
+    # This function reads the next advertisement of the recording, or
+    # returns None at its end. When looping, the times of each pass
+    # follow on from the last.
+    def readNext(self):
+        for line in self.file:
+            fields = line.strip().split(",")
+            if len(fields) != 3: continue
+            try: t = float(fields[0])
+            except ValueError: continue
+            if self.first == None: self.first = t
+            self.last = t
+            return t + self.shift,fields[1],fields[2]
+        if not self.loop or self.first == None: return None
+        self.file.seek(0)
+        self.shift += self.last - self.first
+        return self.readNext()
+
+    def start(self,passive=False):
+        if self.file == None:
+            self.file = open(self.path, "rt")
+            self.next = self.readNext()
+
+    def stop(self): pass
+
+    # This function closes the recording.
+    def close(self):
+        if self.file != None: self.file.close()
+
+    # This function passes on the advertisements of the next timeout
+    # seconds of the recording.
+    def process(self,timeout=10.0):
+        if self.file == None: self.start()
+        if self.realtime: time.sleep(timeout)
+        if self.next == None: return
+        if self.clock == None: self.clock = self.next[0]
+        self.clock += timeout * self.speed
+        while self.next != None and self.next[0] <= self.clock:
+            t,mac,ManuData = self.next
+            self.advertise(mac,ManuData)
+            self.next = self.readNext()
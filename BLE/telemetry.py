@@ -0,0 +1,119 @@
+
+# telemetry.py
+
+# This file keeps statistics on the acquisition, to tell why a channel has
+# no data: its sensor stopped advertising, its advertisements could not
+# be decoded, the scans were too short, or the program fell behind. For
+# each sensor, the advertisements received and the ones that could not
+# be decoded are counted by the scan. For each adapter, the time taken by
+# each scan is kept. For the program, the lateness of each scheduled
+# deadline, the deadlines missed, and the time taken by stages such as
+# saving and redrawing are kept.
+
+# The statistics are shown as lines of text by btpressure.py, and can be
+# appended to a metrics file, one JSON object per line.
+
+
+import json
+import time
+
+from series import RunningStats
+
+# This function returns the count, mean, and largest value of a running
+# statistic, as a dictionary.
+def summary(stats):
+    return {"count":stats.count,"mean":stats.mean(),"max":stats.high}
+
+# This function formats a number of seconds as milliseconds.
+def ms(seconds):
+    if seconds == None: return "-"
+    return "%.1f" % (1000 * seconds)
+
+# This class keeps the statistics of a run. The source is the ScanGroup
+# or FollowThread samples are taken from. The deadlines of schedule, a
+# Schedule of schedule.py, and the spans of profiler, a Profiler of
+# profiling.py, are reported if given.
+class Telemetry(object):
+
+    def __init__(self,registry,source,schedule=None,profiler=None):
+        self.registry = registry # known sensors
+        self.source = source # supplies counts, scanTimes, and health
+        self.schedule = schedule # deadlines, if any
+        self.profiler = profiler # timing spans, if any
+        self.start = time.time()
+        self.stages = dict() # name -> RunningStats of seconds per call
+
+    # This function calls fcn, recording how long it took under name.
+    def time(self,name,fcn,*args):
+        start = time.time()
+        result = fcn(*args)
+        stats = self.stages.get(name)
+        if stats == None: stats = self.stages[name] = RunningStats()
+        stats.add(time.time() - start)
+        return result
+
+    # This function returns all statistics as a dictionary.
+    def snapshot(self):
+        now = time.time()
+        minutes = max(now - self.start,1e-9) / 60.0
+        received,failed,lastHeard = self.source.counts()
+        sensors = []
+        for sensor in self.registry.sensors:
+            i = sensor.channel
+            sensors.append({"mac":sensor.mac,"label":sensor.label,
+                "received":received[i],"failed":failed[i],
+                "perMinute":received[i] / minutes,
+                "sinceHeard":None if lastHeard[i] == None
+                    else now - lastHeard[i]})
+        scans = dict(("hci%d" % iface,summary(stats))
+            for iface,stats in self.source.scanTimes())
+        deadlines = dict()
+        if self.schedule != None:
+            for name,deadline in self.schedule.deadlines.items():
+                deadlines[name] = summary(deadline.late)
+                deadlines[name]["missed"] = deadline.missed
+        return {"time":now,"uptime":now - self.start,"sensors":sensors,
+            "scans":scans,"adapters":self.source.health(),
+            "deadlines":deadlines,
+            "spans":{} if self.profiler == None else self.profiler.snapshot(),
+            "stages":dict((name,summary(stats))
+                for name,stats in self.stages.items())}
+
+    # This function returns the statistics as lines of text.
+    def lines(self):
+        snapshot = self.snapshot()
+        lines = ["%-8s %-17s %7s %5s %6s %6s" % ("sensor","address",
+            "adverts","bad","/min","last s")]
+        for i,sensor in enumerate(snapshot["sensors"]):
+            label = sensor["label"] if sensor["label"] != "" else str(i+1)
+            last = sensor["sinceHeard"]
+            lines.append("%-8s %-17s %7d %5d %6.1f %6s" % (label[:8],
+                sensor["mac"],sensor["received"],sensor["failed"],
+                sensor["perMinute"],"-" if last == None else "%.0f" % last))
+        states = dict(("hci%d" % health["iface"],health)
+            for health in snapshot["adapters"])
+        for name in sorted(snapshot["scans"]):
+            scan = snapshot["scans"][name]
+            line = "%s scan: %d calls, mean %s ms, max %s ms" % (name,
+                scan["count"],ms(scan["mean"]),ms(scan["max"]))
+            if name in states:
+                line += ", %s, %d resets" % (states[name]["state"],
+                    states[name]["resets"])
+                if states[name]["error"] != None:
+                    line += ", " + states[name]["error"]
+            lines.append(line)
+        for name in sorted(snapshot["deadlines"]):
+            deadline = snapshot["deadlines"][name]
+            lines.append("%s: %d due, %d missed, late by mean %s ms, "
+                "max %s ms" % (name,deadline["count"],deadline["missed"],
+                ms(deadline["mean"]),ms(deadline["max"])))
+        for name in sorted(snapshot["stages"]):
+            stage = snapshot["stages"][name]
+            lines.append("%s: %d calls, mean %s ms, max %s ms" % (name,
+                stage["count"],ms(stage["mean"]),ms(stage["max"])))
+        return lines
+
+    # This function appends the statistics to a metrics file.
+    def dump(self,path):
+        with open(path, "at") as f:
+            f.write(json.dumps(self.snapshot(),sort_keys=True) + "\n")
@@ -0,0 +1,181 @@
+
+# tpms.py
+
+# This file converts the manufacturer data advertised by the bluetooth
+# TPMS sensors into pressure and temperature values, and loads the
+# registry of known sensors. It is shared by bscan.py and btpressure.py.
+
+
+import os
+import struct
+import binascii
+import array
+
+# numpy is optional, and only speeds up batch decoding
+try: import numpy
+except ImportError: numpy = None
+
+# default registry of sensors, found next to this file
+SENSOR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "sensors.csv")
+
+# default manual calibration: pressure slope and intercept, followed by
+# temperature slope and intercept
+CALIBRATION = (0.000146885,0.626175,0.00977033,0.0214060)
+
+
+# This function splits a string hex number into a decimal number.
+def hexify(txt):
+    hx = ""
+    for i in range(len(txt)//2):
+        hx = txt[2*i] + txt[2*i+1] + hx
+    dec = int(hx, 16)
+    return dec
+
+# This function converts a sensor value to a pressure value (PSI) based
+# on manual calibration.
+def toPressure(dec,slope=CALIBRATION[0],yint=CALIBRATION[1]):
+    return round(dec*slope+yint,1)
+
+# This function converts a sensor value to a temperature value (C) based
+# on manual calibration.
+def toTemp(dec,slope=CALIBRATION[2],yint=CALIBRATION[3]):
+    return round(dec*slope+yint,1)
+
+# This function returns the raw pressure and temperature counts from the
+# hex string of manufacturer data, or None if the data is too short. Both
+# values are little-endian 32 bit counts, starting at the ninth byte.
+def counts(ManuData):
+    if ManuData == None or len(ManuData) < 32: return None
+    return struct.unpack("<II",binascii.unhexlify(ManuData[16:32]))
+
+# This function converts raw pressure and temperature counts to values.
+def convert(raw,calibration=CALIBRATION):
+    pSlope,pYint,tSlope,tYint = calibration
+    pDec,tDec = raw
+    return toPressure(pDec,pSlope,pYint),toTemp(tDec,tSlope,tYint)
+
+# This function decodes the pressure and temperature from the hex string
+# of manufacturer data, or returns None if the data is too short.
+def decode(ManuData,calibration=CALIBRATION):
+    raw = counts(ManuData)
+    if raw == None: return None
+    return convert(raw,calibration)
+
+# This function makes the hex string of manufacturer data that decodes to
+# the given pressure and temperature, the reverse of decode.
+def encode(pressure,temp,calibration=CALIBRATION):
+    pSlope,pYint,tSlope,tYint = calibration
+    pDec = max(0,int(round((pressure-pYint)/pSlope)))
+    tDec = max(0,int(round((temp-tYint)/tSlope)))
+    fields = binascii.hexlify(struct.pack("<II",pDec,tDec))
+    return "00"*8 + fields.decode("ascii")
+
+# This function rounds an array of values the same way round does. numpy
+# rounds exact halves to even, so values within reach of a half are
+# rounded again individually.
+def roundArray(values,places=1):
+    rounded = numpy.round(values,places)
+    scaled = values*10**places
+    near = numpy.abs(scaled-numpy.floor(scaled)-0.5) < 1e-6
+    for i in numpy.flatnonzero(near):
+        rounded[i] = round(float(values[i]),places)
+    return rounded
+
+# This function decodes many hex strings of manufacturer data at once,
+# such as a replayed capture. It returns an array of pressures and an
+# array of temperatures, matching decode value for value. Data that is
+# too short to decode gives nan for both values. The arrays are numpy
+# arrays if numpy is installed, and float arrays otherwise.
+def decodeBatch(payloads,calibration=CALIBRATION):
+    pSlope,pYint,tSlope,tYint = calibration
+    fields = []
+    bad = []
+    for i,ManuData in enumerate(payloads):
+        if ManuData == None or len(ManuData) < 32:
+            bad.append(i)
+            fields.append("0"*16)
+        else: fields.append(ManuData[16:32])
+    # both counts of every payload, unpacked in a single call
+    blob = binascii.unhexlify("".join(fields))
+    if numpy != None:
+        counts = numpy.frombuffer(blob,dtype="<u4").reshape(-1,2)
+        pressures = roundArray(counts[:,0]*pSlope+pYint)
+        temps = roundArray(counts[:,1]*tSlope+tYint)
+        pressures[bad] = temps[bad] = numpy.nan
+    else:
+        counts = struct.unpack("<%dI" % (2*len(fields)),blob)
+        pressures = array.array("d",
+            [round(dec*pSlope+pYint,1) for dec in counts[0::2]])
+        temps = array.array("d",
+            [round(dec*tSlope+tYint,1) for dec in counts[1::2]])
+        for i in bad: pressures[i] = temps[i] = float("nan")
+    return pressures,temps
+
+####################################
+# Sensor Registry
+####################################
+
+# This class defines a single known sensor: the channel its data is
+# recorded in, its MAC address, its label, and its calibration.
+class Sensor(object):
+
+    def __init__(self,channel,mac,label,calibration=CALIBRATION):
+        self.channel = channel # index of dataset
+        self.mac = mac.lower() # as reported by the scanner
+        self.label = label # dataset name, empty if not recorded
+        self.calibration = calibration
+
+    # This function decodes manufacturer data with this sensor's
+    # calibration.
+    def decode(self,ManuData):
+        return decode(ManuData,self.calibration)
+
+    # This function converts raw counts with this sensor's calibration.
+    def convert(self,raw):
+        return convert(raw,self.calibration)
+
+# This class holds all known sensors, so that a scanned device is matched
+# to its channel with a single dictionary lookup.
+class SensorRegistry(object):
+
+    def __init__(self,sensors):
+        self.sensors = sensors # ordered by channel
+        self.byMac = dict((sensor.mac,sensor) for sensor in sensors)
+
+    def __len__(self):
+        return len(self.sensors)
+
+    # This function returns the sensor with the given address, or None
+    # if the device is not a known sensor.
+    def lookup(self,mac):
+        return self.byMac.get(mac)
+
+    # This function returns the addresses of all sensors in channel order.
+    def macs(self):
+        return [sensor.mac for sensor in self.sensors]
+
+    # This function returns the labels of all sensors in channel order.
+    def labels(self):
+        return [sensor.label for sensor in self.sensors]
+
+# This function reads the registry of sensors from a file. Each line holds
+# a MAC address, a label, and optionally the four calibration constants,
+# separated by commas. The channel of a sensor is its line in the file.
+# Blank lines and lines starting with # are ignored.
+def loadRegistry(path=SENSOR_FILE):
+    sensors = []
+    with open(path, "rt") as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#"): continue
+            fields = [field.strip() for field in line.split(",")]
+            mac = fields[0]
+            label = fields[1] if len(fields) > 1 else ""
+            if len(fields) > 2:
+                calibration = tuple(map(float,fields[2:6]))
+                if len(calibration) != 4:
+                    raise ValueError("bad calibration for sensor " + mac)
+            else: calibration = CALIBRATION
+            sensors.append(Sensor(len(sensors),mac,label,calibration))
+    return SensorRegistry(sensors)